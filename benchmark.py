@@ -0,0 +1,621 @@
+"""Offline load test for ChatCog.
+
+Runs the real cog against a local stand-in for the Groq API and fake Discord
+objects, so throughput and latency can be measured without either service:
+
+    python benchmark.py --channels 50 --messages 20 --voice-fraction 0.2 --audio-fraction 0.1
+
+Cog settings come from the environment as usual (COALESCE_WINDOW, GROQ_MAX_CONCURRENCY, ...).
+Voice channels need FFmpeg, set FFMPEG_PATH if it isn't on PATH.
+
+With --listen-guilds N, scripted speakers talk in N voice channels the cog listens to, which
+runs voice activity detection, speech-to-text and the replies like a real voice connection.
+
+With --state redis the cog keeps its shared state in a local Redis-compatible stand-in
+instead of in process, the same path a multi-process deployment takes.
+"""
+import argparse
+import array
+import asyncio
+import functools
+import importlib.util
+import io
+import itertools
+import json
+import math
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import wave
+from collections import defaultdict
+
+from aiohttp import web
+
+COG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts-stt.py")
+REPLY_WORDS = (
+    "That sounds really interesting. How did it make you feel when it happened? "
+    "I'd love to hear more about it, and what you are planning to do next."
+).split()
+
+def make_wav(seconds, sample_rate=16000, noise=False):
+    frames = int(seconds * sample_rate)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        # Random noise makes every clip unique, so transcript dedup doesn't hide the upload path
+        wav.writeframes(os.urandom(frames * 2) if noise else bytes(frames * 2))
+    return buffer.getvalue()
+
+@functools.lru_cache(maxsize=None)
+def speech_second(sample_rate=48000, channels=2, frequency=180.0):
+    # Built once, generating samples in Python on every clip would block the loop being measured
+    samples = array.array("h")
+    for index in range(sample_rate):
+        value = int(6000 * math.sin(2 * math.pi * frequency * index / sample_rate) + random.uniform(-800, 800))
+        samples.extend([value] * channels)
+    return samples.tobytes()
+
+def make_speech(seconds, sample_rate=48000, channels=2):
+    """Voiced-sounding PCM as Discord sends it, loud enough for the cog's voice activity detection"""
+    second = speech_second(sample_rate, channels)
+    size = int(seconds * sample_rate) * channels * 2
+    return (second * (size // len(second) + 1))[:size]
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+
+class GroqStandIn:
+    """Local server speaking enough of the Groq API for the cog, plus a CDN for attachments"""
+    def __init__(self, args):
+        self.args = args
+        self.files = {}
+        self.requests = defaultdict(int)
+        self.injected_errors = 0
+
+    def latency(self, mean):
+        return random.uniform(0.5, 1.5) * mean
+
+    def injected_error(self):
+        roll = random.random()
+        if roll < self.args.rate_limit_rate:
+            self.injected_errors += 1
+            return web.json_response({"error": {"message": "Rate limit reached"}}, status=429, headers={"Retry-After": "1"})
+        if roll < self.args.rate_limit_rate + self.args.error_rate:
+            self.injected_errors += 1
+            return web.json_response({"error": {"message": "Service unavailable"}}, status=503)
+        return None
+
+    async def chat(self, request):
+        payload = await request.json()
+        self.requests["chat"] += 1
+        await asyncio.sleep(self.latency(self.args.llm_ttfb))
+        error = self.injected_error()
+        if error is not None:
+            return error
+        words = [random.choice(REPLY_WORDS) for _ in range(self.args.reply_tokens)]
+
+        if not payload.get("stream"):
+            await asyncio.sleep(self.args.token_interval * len(words))
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": " ".join(words)}}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in words:
+            chunk = {"choices": [{"delta": {"content": word + " "}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.latency(self.args.token_interval))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def transcribe(self, request):
+        form = await request.post()
+        self.requests["transcription"] += 1
+        size = len(form["file"].file.read())
+        await asyncio.sleep(self.latency(self.args.stt_latency))
+        error = self.injected_error()
+        if error is not None:
+            return error
+        return web.json_response({"text": f"this is a voice note of {size} bytes"})
+
+    async def download(self, request):
+        self.requests["download"] += 1
+        audio = self.files.get(request.match_info["name"])
+        if audio is None:
+            return web.Response(status=404)
+        return web.Response(body=audio, content_type="audio/wav")
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/openai/v1/chat/completions", self.chat)
+        app.router.add_post("/openai/v1/audio/transcriptions", self.transcribe)
+        app.router.add_get("/files/{name}", self.download)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base_url = "http://127.0.0.1:%d" % site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+class RespStandIn:
+    """In-memory server speaking the subset of the Redis protocol the cog's state backend uses"""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.values = {}  # key -> (value, expires at or None)
+        self.commands = defaultdict(int)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        self.url = "redis://127.0.0.1:%d/0" % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:])):
+                    size = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(size + 2))[:-2].decode())
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write(self.execute(args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def live(self, key):
+        entry = self.values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.values[key]
+            entry = None
+        return entry
+
+    def execute(self, args):
+        command = args[0].upper()
+        self.commands[command] += 1
+        if command in ("PING", "AUTH", "SELECT"):
+            return b"+PONG\r\n" if command == "PING" else b"+OK\r\n"
+        if command == "GET":
+            entry = self.live(args[1])
+            if entry is None:
+                return b"$-1\r\n"
+            data = entry[0].encode()
+            return b"$%d\r\n%s\r\n" % (len(data), data)
+        if command == "SET":
+            key, value, options = args[1], args[2], [option.upper() for option in args[3:]]
+            if "NX" in options and self.live(key) is not None:
+                return b"$-1\r\n"
+            expires = None
+            if "PX" in options:
+                expires = time.monotonic() + int(options[options.index("PX") + 1]) / 1000
+            elif "EX" in options:
+                expires = time.monotonic() + int(options[options.index("EX") + 1])
+            self.values[key] = (value, expires)
+            return b"+OK\r\n"
+        if command == "DEL":
+            return b":%d\r\n" % sum(1 for key in args[1:] if self.values.pop(key, None) is not None)
+        return b"-ERR unknown command '%s'\r\n" % command.encode()
+
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id
+        self.name = self.display_name = name
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+
+    def mentioned_in(self, message):
+        return self in message.mentions
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.members = {}
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+class FakeMessage:
+    ids = itertools.count(1)
+
+    def __init__(self, channel, author, content="", attachments=(), mentions=()):
+        self.id = next(self.ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.attachments = list(attachments)
+        self.mentions = list(mentions)
+        self.mention_everyone = False
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.api_call()
+        self.content = content
+
+    async def delete(self):
+        await self.channel.api_call()
+
+    async def add_reaction(self, emoji):
+        await self.channel.api_call()
+
+class FakeTyping:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def __aenter__(self):
+        await self.channel.api_call()
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakeChannel:
+    """Text channel that answers every REST call after a simulated round trip"""
+    def __init__(self, channel_id, guild, bot_user, api_latency):
+        self.id = channel_id
+        self.guild = guild
+        self.bot_user = bot_user
+        self.api_latency = api_latency
+        self.sent = []
+        self.api_calls = 0
+
+    async def api_call(self):
+        self.api_calls += 1
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.api_latency)
+
+    async def send(self, content=None, embed=None, **kwargs):
+        await self.api_call()
+        message = FakeMessage(self, self.bot_user, content or "")
+        self.sent.append(message)
+        return message
+
+    def typing(self):
+        return FakeTyping(self)
+
+class FakeVoiceClient:
+    """Plays sources on a thread like nextcord's AudioPlayer, optionally in real time"""
+    FRAME_SECONDS = 0.02
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self.playing = None
+        self.frames = 0
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self.playing is not None and self.playing.is_alive()
+
+    def play(self, source, after=None):
+        stopped = threading.Event()
+
+        def run():
+            error = None
+            try:
+                while not stopped.is_set():
+                    if not source.read():
+                        break
+                    self.frames += 1
+                    if self.realtime:
+                        time.sleep(self.FRAME_SECONDS)
+            except Exception as e:
+                error = e
+            # Same order as nextcord's AudioPlayer
+            if after:
+                after(error)
+            source.cleanup()
+
+        self.stop_event = stopped
+        self.playing = threading.Thread(target=run, daemon=True)
+        self.playing.start()
+
+    def stop(self):
+        if self.playing is not None:
+            self.stop_event.set()
+
+class FakeVoiceSource:
+    """Stands in for a listening voice connection, plays scripted clips per speaker at real-time pace"""
+    FRAME_SECONDS = 0.02
+    BYTES_PER_SECOND = 48000 * 2 * 2  # 48 kHz stereo s16le, what Discord's Opus decodes to
+
+    def __init__(self, clips):
+        # clips: (speaker_id, PCM, start offset in seconds)
+        self.clips = clips
+        self.packets = 0
+        self.finished = asyncio.Event()
+
+    async def listen(self, feed):
+        frame_bytes = int(self.BYTES_PER_SECOND * self.FRAME_SECONDS)
+        events = []
+        for speaker_id, pcm, start in self.clips:
+            for index, offset in enumerate(range(0, len(pcm), frame_bytes)):
+                events.append((start + index * self.FRAME_SECONDS, speaker_id, pcm[offset:offset + frame_bytes]))
+        events.sort(key=lambda event: event[0])
+
+        began = time.monotonic()
+        for at, speaker_id, frame in events:
+            delay = began + at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            feed(speaker_id, frame)
+            self.packets += 1
+        self.finished.set()
+
+    def stats(self):
+        return {"packets": self.packets}
+
+class FakeBot:
+    def __init__(self):
+        self.user = FakeUser(1, "ChatBot", bot=True)
+
+    @property
+    def loop(self):
+        return asyncio.get_running_loop()
+
+    async def wait_until_ready(self):
+        pass
+
+    def is_closed(self):
+        return False
+
+def load_cog_module():
+    spec = importlib.util.spec_from_file_location("chat_cog", COG_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def bench_cog_class(module, tts_latency):
+    class BenchChatCog(module.ChatCog):
+        def synthesize_audio(self, text, slow):
+            # Stands in for gTTS: a network round trip, then roughly speech-length audio
+            time.sleep(random.uniform(0.5, 1.5) * tts_latency)
+            return make_wav(min(len(text) * 0.06, 10), sample_rate=8000)
+    return BenchChatCog
+
+async def run_channel(cog, args, server, channel, user, voice, results):
+    for index in range(args.messages):
+        if random.random() < args.audio_fraction:
+            name = f"{channel.id}-{index}.wav"
+            server.files[name] = make_wav(args.audio_seconds, noise=True)
+            attachment = type("FakeAttachment", (), {
+                "id": channel.id * 100000 + index, "filename": name, "size": len(server.files[name]),
+                "url": f"{server.base_url}/files/{name}", "content_type": "audio/wav"
+            })()
+            message = FakeMessage(channel, user, attachments=[attachment])
+            kind = "e2e_audio_message"
+        else:
+            content = f"{cog.bot.user.mention} tell me something nice, message {index}"
+            message = FakeMessage(channel, user, content, mentions=[cog.bot.user])
+            kind = "e2e_text_message"
+
+        started = time.perf_counter()
+        await cog.on_message(message)
+        inbox = cog.inboxes.get(str(channel.id))
+        if inbox is not None and inbox.worker is not None:
+            await inbox.worker
+        results[kind].append(time.perf_counter() - started)
+
+        if voice:
+            await cog.playback[channel.guild.id].drain()
+            results["e2e_voice_played"].append(time.perf_counter() - started)
+        results["messages"].append(1)
+
+        await asyncio.sleep(random.uniform(0.5, 1.5) * args.think_time)
+
+async def run_listener(cog, args, index, channels):
+    guild = FakeGuild(5000 + index)
+    speakers = []
+    for number in range(args.speakers):
+        user = FakeUser(50000 + index * 100 + number, f"speaker{index}-{number}")
+        guild.members[user.id] = user
+        speakers.append(user)
+    channel = FakeChannel(6000 + index, guild, cog.bot.user, args.discord_latency)
+    channels.append(channel)
+
+    # Speakers take turns, each utterance followed by a pause long enough to end it
+    clips = []
+    at = random.uniform(0, 0.5)
+    for _ in range(args.utterances):
+        for user in speakers:
+            seconds = random.uniform(0.7, 1.3) * args.utterance_seconds
+            clips.append((user.id, make_speech(seconds), at))
+            at += seconds + args.utterance_gap
+    source = FakeVoiceSource(clips)
+    cog.start_listening(guild, source, channel)
+    await source.finished.wait()
+    return len(clips)
+
+async def run(args):
+    server = GroqStandIn(args)
+    await server.start()
+    state_server = None
+    if args.state == "redis":
+        state_server = RespStandIn(latency=args.state_latency)
+        await state_server.start()
+
+    workdir = tempfile.mkdtemp(prefix="chatcog-bench-")
+    os.environ.update({
+        "GROQ_API_KEY": "bench",
+        "GROQ_API_BASE": f"{server.base_url}/openai/v1",
+        "CHAT_STREAMING": "1" if args.stream else "0",
+        "HISTORY_DB": os.path.join(workdir, "chat_history.db"),
+        "STT_CACHE_DB": os.path.join(workdir, "transcripts.db"),
+        "TTS_CACHE_DIR": os.path.join(workdir, "tts_cache"),
+        "PREFERENCES_FILE": os.path.join(workdir, "user_preferences.json"),
+        "METRICS_PORT": "0",
+        "VOICE_RECEIVE": "0",
+        "STATE_BACKEND": args.state
+    })
+    if state_server is not None:
+        os.environ["STATE_REDIS_URL"] = state_server.url
+    # The cog logs to bot.log in the working directory
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    module = load_cog_module()
+    logging.getLogger("ChatBot").setLevel(logging.WARNING if args.verbose else logging.ERROR)
+
+    # Raw samples for exact percentiles, the cog itself only keeps bucketed histograms
+    stage_samples = defaultdict(list)
+    observe = module.metrics.observe
+
+    def record(stage, seconds):
+        stage_samples[stage].append(seconds)
+        observe(stage, seconds)
+    module.metrics.observe = record
+
+    bot = FakeBot()
+    cog = bench_cog_class(module, args.tts_latency)(bot)
+    await cog.http.start()
+
+    results = defaultdict(list)
+    tasks = []
+    channels = []
+    for index in range(args.channels):
+        guild = FakeGuild(1000 + index)
+        user = FakeUser(10000 + index, f"user{index}")
+        guild.members[user.id] = user
+        channel = FakeChannel(2000 + index, guild, bot.user, args.discord_latency)
+        channels.append(channel)
+        voice = index < round(args.channels * args.voice_fraction)
+        if voice:
+            cog.voice_clients[guild.id] = FakeVoiceClient(realtime=args.voice_realtime)
+            cog.playback[guild.id] = module.GuildPlayback(cog.voice_clients[guild.id], executable=cog.ffmpeg_path)
+        tasks.append(run_channel(cog, args, server, channel, user, voice, results))
+
+    listeners = [run_listener(cog, args, index, channels) for index in range(args.listen_guilds)]
+    if listeners:
+        speech_second()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    spoken = sum((await asyncio.gather(*tasks, *listeners))[len(tasks):])
+    if spoken:
+        # The last utterances still have to end, be transcribed and answered
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline and (
+            sum(cog.voice_stats.values()) < spoken or cog.inbound.outstanding or cog.inboxes
+        ):
+            await asyncio.sleep(0.05)
+        for guild_id in list(cog.listeners):
+            cog.stop_listening(guild_id)
+    elapsed = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+
+    report = {
+        "channels": args.channels,
+        "messages": len(results.pop("messages", [])),
+        "elapsed_s": round(elapsed, 2),
+        "stand_in_requests": dict(server.requests),
+        "injected_errors": server.injected_errors,
+        "groq_retries": cog.http.scheduler.retries,
+        "discord_calls": sum(channel.api_calls for channel in channels),
+        "cosmetic_dropped": cog.rest_budget.stats()["cosmetic_dropped"],
+        "state_commands": dict(state_server.commands) if state_server else {},
+        "utterances_spoken": spoken,
+        "voice_listening": dict(cog.voice_stats),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": {}
+    }
+    report["messages_per_s"] = round(report["messages"] / elapsed, 2)
+    if traced_peak is not None:
+        report["peak_traced_mb"] = round(traced_peak / 1024 / 1024, 1)
+    for stage, samples in sorted({**stage_samples, **results}.items()):
+        if samples:
+            report["stages"][stage] = {
+                "n": len(samples),
+                "p50_ms": round(percentile(samples, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(samples, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(samples, 0.99) * 1000, 1)
+            }
+
+    cog.cog_unload()
+    pending = asyncio.all_tasks() - {asyncio.current_task()}
+    if pending:
+        await asyncio.wait(pending, timeout=5)
+    await server.stop()
+    if state_server is not None:
+        await state_server.stop()
+    os.chdir(previous_cwd)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def print_report(report):
+    print(f"{report['messages']} messages over {report['channels']} channels in {report['elapsed_s']}s "
+          f"({report['messages_per_s']} msgs/s)")
+    print(f"peak RSS {report['peak_rss_mb']} MB" + (
+        f", peak traced {report['peak_traced_mb']} MB" if "peak_traced_mb" in report else ""))
+    print(f"stand-in requests {report['stand_in_requests']}, injected errors {report['injected_errors']}, "
+          f"client retries {report['groq_retries']}")
+    print(f"discord REST calls {report['discord_calls']}, cosmetic calls dropped {report['cosmetic_dropped']}")
+    if report["utterances_spoken"]:
+        print(f"utterances spoken {report['utterances_spoken']}, voice listening {report['voice_listening']}")
+    if report["state_commands"]:
+        print(f"state backend commands {report['state_commands']}")
+    print(f"\n{'stage':<24}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, row in report["stages"].items():
+        print(f"{stage:<24}{row['n']:>7}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ChatCog load test against a local Groq stand-in")
+    parser.add_argument("--channels", type=int, default=20, help="Simulated channels talking at once")
+    parser.add_argument("--messages", type=int, default=10, help="Messages per channel")
+    parser.add_argument("--voice-fraction", type=float, default=0.0, help="Share of channels with a voice connection")
+    parser.add_argument("--voice-realtime", action="store_true", help="Play voice at real speed instead of as fast as possible")
+    parser.add_argument("--audio-fraction", type=float, default=0.0, help="Share of messages that are voice notes")
+    parser.add_argument("--audio-seconds", type=float, default=5.0, help="Length of each voice note")
+    parser.add_argument("--listen-guilds", type=int, default=0, help="Voice channels with scripted speakers the cog listens to")
+    parser.add_argument("--speakers", type=int, default=2, help="Speakers per listened voice channel")
+    parser.add_argument("--utterances", type=int, default=3, help="Utterances per speaker")
+    parser.add_argument("--utterance-seconds", type=float, default=1.5, help="Mean length of an utterance")
+    parser.add_argument("--utterance-gap", type=float, default=1.0, help="Silence after each utterance")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True, help="Streamed completions")
+    parser.add_argument("--llm-ttfb", type=float, default=0.3, help="Mean seconds before the first completion byte")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="Mean seconds between streamed tokens")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="Words per reply")
+    parser.add_argument("--stt-latency", type=float, default=0.5, help="Mean seconds per transcription")
+    parser.add_argument("--tts-latency", type=float, default=0.2, help="Mean seconds per synthesized sentence")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Mean seconds per Discord REST call")
+    parser.add_argument("--think-time", type=float, default=0.5, help="Mean seconds a user waits before the next message")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of API calls answered with a 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of API calls answered with a 429")
+    parser.add_argument("--state", choices=("local", "redis"), default="local", help="State backend, redis runs a local stand-in")
+    parser.add_argument("--state-latency", type=float, default=0.0, help="Seconds the Redis stand-in takes per command")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--tracemalloc", action="store_true", help="Also trace Python allocations, slows the run down")
+    parser.add_argument("--json", metavar="PATH", help="Write the report as JSON, e.g. to diff against a baseline")
+    parser.add_argument("--verbose", action="store_true", help="Show the cog's warnings")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.voice_fraction and not shutil.which(os.getenv("FFMPEG_PATH", "ffmpeg")):
+        sys.exit("Voice channels need FFmpeg, set FFMPEG_PATH")
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
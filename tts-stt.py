@@ -1,15 +1,44 @@
 import nextcord
 from nextcord.ext import commands
 import aiohttp
+from aiohttp import web
 import os
 import asyncio
+import bisect
 import json
 import random
+import re
+import shutil
+import socket
 import time
 from gtts import gTTS
 from nextcord import FFmpegPCMAudio, Embed, Color
 import logging
+import contextlib
+import contextvars
+import functools
+import hashlib
+import heapq
+import itertools
+import math
+import io
+import array
+import struct
+import sys
+import wave
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+try:
+    import nacl.secret
+except ImportError:  # Only needed to receive voice, nextcord needs it to connect at all
+    nacl = None
 
 # Set up logging
 logging.basicConfig(
@@ -19,12 +48,2615 @@ logging.basicConfig(
 )
 logger = logging.getLogger("ChatBot")
 
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".m4a", ".ogg")
+# Non audio/* types Discord's CDN uses for audio containers
+AUDIO_CONTENT_TYPES = ("application/ogg", "video/ogg", "video/mp4", "application/octet-stream")
+
+class AudioRejected(Exception):
+    """Raised when an attachment turns out to be unsuitable for transcription"""
+
+class AudioPreprocessingError(Exception):
+    """Raised when FFmpeg can't decode or encode a clip"""
+
+class ModelRequestError(Exception):
+    """Raised when a chat model answers with an error status"""
+
+class ModelUnavailable(Exception):
+    """Raised when no chat model produced a reply"""
+
+class StateBackendError(Exception):
+    """Raised when the shared state backend can't be reached or rejects a command"""
+
+class Histogram:
+    """Fixed-bucket latency histogram, cheap enough to update on every request"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile, good enough to see where time goes"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics:
+    """In-process stage timings, in-flight gauges and event counters, rendered for Prometheus"""
+    BUCKET_LABELS = [str(bound) for bound in Histogram.BUCKETS] + ["+Inf"]
+    
+    def __init__(self, prefix="chatbot"):
+        self.prefix = prefix
+        self.histograms = {}  # stage -> Histogram
+        self.in_flight = {}  # stage -> requests currently inside it
+        self.events = {}  # name -> count
+        self.collectors = {}  # component -> callable returning its stats() dict
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time a block, works around awaits too since it only reads the clock twice"""
+        self.in_flight[stage] = self.in_flight.get(stage, 0) + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+            self.in_flight[stage] -= 1
+
+    def count(self, event, amount=1):
+        self.events[event] = self.events.get(event, 0) + amount
+
+    def collect(self, component, stats):
+        """Export a component's numeric stats() values as gauges on every scrape"""
+        self.collectors[component] = stats
+
+    def summary(self):
+        """Per-stage one-liners for the owner stats embed"""
+        lines = {}
+        for stage, histogram in sorted(self.histograms.items()):
+            p50, p95 = histogram.quantile(0.5), histogram.quantile(0.95)
+            lines[stage] = (
+                f"n={histogram.count} p50≤{p50 * 1000:.0f}ms p95≤{p95 * 1000:.0f}ms "
+                f"max={histogram.max * 1000:.0f}ms in_flight={self.in_flight.get(stage, 0)}"
+            )
+        return lines
+
+    def render(self):
+        """Prometheus text exposition format"""
+        name = f"{self.prefix}_stage_seconds"
+        lines = [f"# HELP {name} Time spent per stage of handling a turn", f"# TYPE {name} histogram"]
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKET_LABELS, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+            
+        name = f"{self.prefix}_stage_in_flight"
+        lines += [f"# HELP {name} Work currently inside each stage", f"# TYPE {name} gauge"]
+        lines += [f'{name}{{stage="{stage}"}} {value}' for stage, value in sorted(self.in_flight.items())]
+        
+        name = f"{self.prefix}_events_total"
+        lines += [f"# HELP {name} Counted events", f"# TYPE {name} counter"]
+        lines += [f'{name}{{event="{event}"}} {value}' for event, value in sorted(self.events.items())]
+        
+        for component, stats in sorted(self.collectors.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                logger.warning(f"Metrics collector {component} failed: {str(e)}")
+                continue
+            for key, value in values.items():
+                # Preformatted values like hit rates are skipped, their raw counts are exported
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric = re.sub(r"[^a-zA-Z0-9_]", "_", f"{self.prefix}_{component}_{key}")
+                lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+# Module-wide so helper classes can time their stages without being handed a reference
+metrics = Metrics()
+
+class TokenBucket:
+    """Classic token bucket, refilled continuously at a per-minute rate"""
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        # A caller may have read the clock just before this bucket was created
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = max(self.updated, now)
+
+    def wait_time(self, amount, now):
+        if self.rate <= 0:
+            return 0.0  # Unlimited
+        self._refill(now)
+        amount = min(amount, self.capacity)  # Oversized requests still get through once the bucket is full
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        if self.rate > 0:
+            self.tokens -= min(amount, self.capacity)
+
+class RequestScheduler:
+    """Admission control for outbound Groq requests: rate buckets, a concurrency cap and priorities"""
+    PRIORITY_VOICE = 0  # Replies someone is waiting to hear
+    PRIORITY_TEXT = 1
+    PRIORITY_BACKGROUND = 2  # Summaries and other housekeeping
+    
+    def __init__(self, requests_per_minute=300, tokens_per_minute=100000, max_concurrency=32,
+                 backoff_base=0.5, backoff_max=20.0):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.active = 0
+        self.waiters = []  # Heap of (priority, sequence, future, tokens)
+        self.sequence = itertools.count()
+        self.blocked_until = 0.0  # Shared cooldown after a 429
+        self.timer = None
+        
+        self.admitted = 0
+        self.throttled = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority, tokens):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future, tokens))
+        self._dispatch()
+        try:
+            with metrics.timer("groq_queue_wait"):
+                await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as we got cancelled
+                self._release()
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            # Respect the server, with a little jitter so queued requests don't stampede
+            delay = retry_after + random.uniform(0, min(1.0, retry_after * 0.1))
+        else:
+            # Full jitter exponential backoff
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        return delay
+
+    def pause(self, delay):
+        # Everyone waits out a rate limit, not just the request that hit it
+        self.rate_limited += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.waiters and self.active < self.max_concurrency:
+            priority, sequence, future, tokens = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)  # Cancelled while waiting
+                continue
+            wait = max(
+                self.blocked_until - now,
+                self.request_bucket.wait_time(1, now),
+                self.token_bucket.wait_time(tokens, now)
+            )
+            if wait > 0:
+                # Strict priority: nothing jumps the head of the queue, come back when it fits
+                self.throttled += 1
+                self._schedule(now + wait)
+                return
+            heapq.heappop(self.waiters)
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(tokens)
+            self.active += 1
+            self.admitted += 1
+            future.set_result(None)
+
+    def _schedule(self, when):
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, when - time.monotonic())
+        if self.timer is not None:
+            if self.timer.when() <= loop.time() + delay:
+                return
+            self.timer.cancel()
+        self.timer = loop.call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self._dispatch()
+
+    def stats(self):
+        return {
+            "queued_requests": sum(1 for _, _, future, _ in self.waiters if not future.done()),
+            "active_requests": self.active,
+            "max_concurrency": self.max_concurrency,
+            "admitted": self.admitted,
+            "throttle_waits": self.throttled,
+            "retries": self.retries,
+            "rate_limited_429": self.rate_limited
+        }
+
+class GroqHTTPClient:
+    """Long-lived, pooled HTTP session shared by every Groq API call"""
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    
+    def __init__(self, api_key, pool_size=100, pool_size_per_host=0, keepalive_timeout=30,
+                 dns_cache_ttl=300, connect_timeout=10, default_timeout=60, scheduler=None, max_attempts=4):
+        self.api_key = api_key
+        self.scheduler = scheduler or RequestScheduler()
+        self.max_attempts = max_attempts
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.connect_timeout = connect_timeout
+        self.default_timeout = default_timeout
+        self._session = None
+        
+        # Usage counters for sizing the pool
+        self.requests_total = 0
+        self.request_errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.sessions_created = 0
+
+    @property
+    def session(self):
+        # Created lazily so it is always bound to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.default_timeout, sock_connect=self.connect_timeout)
+            )
+            self.sessions_created += 1
+        return self._session
+
+    async def start(self):
+        return self.session
+
+    @contextlib.asynccontextmanager
+    async def post(self, url, timeout=None, priority=RequestScheduler.PRIORITY_TEXT, tokens=0, body_factory=None,
+                   attempts=None, **kwargs):
+        """POST to Groq through the scheduler, retrying 429s, 5xx and connection errors.
+        
+        A streamed body can't be sent twice, so pass body_factory (an async callable taking an
+        AsyncExitStack and returning request kwargs) to build a fresh one for every attempt.
+        """
+        # Auth is per request, not a session default, so downloads on the same pool never leak the key
+        kwargs["headers"] = {"Authorization": f"Bearer {self.api_key}", **kwargs.get("headers", {})}
+        replayable = body_factory is not None or not isinstance(kwargs.get("data"), aiohttp.FormData)
+        attempts = (attempts or self.max_attempts) if replayable else 1
+        
+        for attempt in range(1, attempts + 1):
+            async with contextlib.AsyncExitStack() as stack:
+                await stack.enter_async_context(self.scheduler.slot(priority, tokens))
+                request_kwargs = dict(kwargs)
+                if body_factory is not None:
+                    request_kwargs.update(await body_factory(stack))
+                try:
+                    response = await stack.enter_async_context(self.request("POST", url, timeout=timeout, **request_kwargs))
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if attempt == attempts:
+                        raise
+                    delay = self.scheduler.backoff(attempt)
+                    logger.warning(f"Groq request failed ({str(e) or type(e).__name__}), retrying in {delay:.1f}s")
+                else:
+                    if response.status not in self.RETRY_STATUSES or attempt == attempts:
+                        yield response
+                        return
+                    retry_after = self.parse_retry_after(response)
+                    delay = self.scheduler.backoff(attempt, retry_after)
+                    if response.status == 429:
+                        self.scheduler.pause(delay)
+                    logger.warning(f"Groq returned HTTP {response.status}, retrying in {delay:.1f}s (attempt {attempt}/{attempts})")
+            # Slot is released while we back off
+            self.scheduler.retries += 1
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def parse_retry_after(response):
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # HTTP-date form
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    @contextlib.asynccontextmanager
+    async def get(self, url, timeout=None, **kwargs):
+        async with self.request("GET", url, timeout=timeout, **kwargs) as response:
+            yield response
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, url, timeout=None, **kwargs):
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout, sock_connect=self.connect_timeout)
+        
+        self.requests_total += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                yield response
+        except Exception:
+            self.request_errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        connector = self._session.connector if self._session and not self._session.closed else None
+        # aiohttp keeps its pool bookkeeping private, so read it defensively
+        acquired = len(getattr(connector, "_acquired", ())) if connector else 0
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values()) if connector else 0
+        return {
+            "pool_size": self.pool_size,
+            "connections_in_use": acquired,
+            "connections_idle": idle,
+            "requests_in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "requests_total": self.requests_total,
+            "request_errors": self.request_errors,
+            "sessions_created": self.sessions_created
+        }
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+class ModelHealth:
+    """Rolling view of one model: time to first output, error rate and circuit state"""
+    def __init__(self, window=50):
+        self.latencies = deque(maxlen=window)
+        self.error_rate = 0.0  # Exponentially weighted, 1.0 means every recent request failed
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.wins = 0
+
+    def record_latency(self, seconds):
+        self.latencies.append(seconds)
+
+    def record_success(self):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.error_rate *= 0.8
+
+    def record_failure(self, threshold, cooldown):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.error_rate = self.error_rate * 0.8 + 0.2
+        if self.consecutive_failures >= threshold:
+            self.cooldown_until = time.monotonic() + cooldown
+
+    def rate_limited(self, seconds):
+        # Groq's limits are per model, sit this one out and let the others serve
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def healthy(self, now):
+        return now >= self.cooldown_until
+
+    def quantile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class ModelRouter:
+    """Routes chat completions to the fastest healthy model, hedging slow ones onto an alternate.
+    
+    The model asked for comes first unless it is cooling down after failures, or (with the
+    "preferred" policy) is more than slow_factor times slower than the best alternative.
+    "fastest" ignores the preference and always ranks by recent tail latency.
+    """
+    def __init__(self, http, url, timeout=60, fallbacks=(), policy="preferred", hedge=True, hedge_after=0.0,
+                 hedge_min=0.5, hedge_max=5.0, max_hedge_ratio=0.2, slow_factor=2.0,
+                 failure_threshold=3, cooldown=30.0, rate_limit_cooldown=5.0, unknown_latency=1.0):
+        self.http = http
+        self.url = url
+        self.timeout = timeout
+        self.fallbacks = list(fallbacks)
+        self.policy = policy
+        self.hedge = hedge
+        self.hedge_after = hedge_after  # 0 = adaptive, from the primary's recent p95
+        self.hedge_min = hedge_min
+        self.hedge_max = hedge_max
+        self.max_hedge_ratio = max_hedge_ratio  # Extra load we're willing to pay for the tail
+        self.slow_factor = slow_factor
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.rate_limit_cooldown = rate_limit_cooldown  # When a 429 comes without Retry-After
+        self.unknown_latency = unknown_latency
+        self.models = {}  # model -> ModelHealth
+        self.recent_hedged = deque(maxlen=100)
+        
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks_used = 0
+        self.exhausted = 0
+        self.rate_limited = 0
+
+    def health(self, model):
+        health = self.models.get(model)
+        if health is None:
+            health = self.models[model] = ModelHealth()
+        return health
+
+    def score(self, model):
+        health = self.health(model)
+        p90 = health.quantile(0.9) if len(health.latencies) >= 5 else None
+        # Errors cost a retry on another model, so they count against an otherwise fast model
+        return (p90 if p90 is not None else self.unknown_latency) * (1 + 2 * health.error_rate)
+
+    def rank(self, preferred):
+        candidates = [preferred] + [model for model in self.fallbacks if model != preferred]
+        now = time.monotonic()
+        healthy = [model for model in candidates if self.health(model).healthy(now)]
+        cooling = sorted((model for model in candidates if model not in healthy),
+                         key=lambda model: self.health(model).cooldown_until)
+        if healthy:
+            if self.policy == "fastest":
+                healthy.sort(key=self.score)
+            else:
+                fastest = min(healthy, key=self.score)
+                if self.score(healthy[0]) > self.slow_factor * self.score(fastest):
+                    healthy.remove(fastest)
+                    healthy.insert(0, fastest)
+        # Cooling models are a last resort, not excluded, better a slow answer than none
+        return healthy + cooling
+
+    def hedge_delay(self, model):
+        if self.hedge_after > 0:
+            return self.hedge_after
+        health = self.health(model)
+        p95 = health.quantile(0.95) if len(health.latencies) >= 5 else None
+        if p95 is None:
+            return self.hedge_max / 2
+        return min(self.hedge_max, max(self.hedge_min, p95))
+
+    def may_hedge(self):
+        if not self.hedge:
+            return False
+        return not self.recent_hedged or sum(self.recent_hedged) / len(self.recent_hedged) < self.max_hedge_ratio
+
+    async def stream(self, payload, priority=RequestScheduler.PRIORITY_TEXT, tokens=0, stream=True):
+        """Yield the reply as text chunks from whichever model answers first.
+        
+        Raises ModelUnavailable if every model failed before producing any output. A failure after
+        output has started is raised as is, the caller has already shown part of that reply.
+        """
+        self.requests += 1
+        remaining = self.rank(payload["model"])
+        events = asyncio.Queue()  # (attempt, kind, value) from every running attempt
+        running = {}  # attempt -> (model, task)
+        sequence = itertools.count()
+        errors = []
+        hedged = False
+        winner = None
+        
+        def launch():
+            model = remaining.pop(0)
+            attempt = next(sequence)
+            # Only the last candidate retries on its own, otherwise moving on to another model is faster
+            task = asyncio.create_task(self.attempt(attempt, model, payload, priority, tokens, stream, events, not remaining))
+            running[attempt] = (model, task)
+            return model
+            
+        try:
+            hedge_at = time.monotonic() + self.hedge_delay(launch())
+            while winner is None:
+                timeout = hedge_at - time.monotonic() if hedge_at is not None else None
+                try:
+                    attempt, kind, value = await asyncio.wait_for(events.get(), timeout=max(0.0, timeout) if timeout is not None else None)
+                except asyncio.TimeoutError:
+                    hedge_at = None
+                    if remaining and self.may_hedge():
+                        # No output yet from the primary, race it against the next best model
+                        hedged = True
+                        self.hedges += 1
+                        logger.info(f"Hedging slow {running[min(running)][0]} request onto {remaining[0]}")
+                        launch()
+                    continue
+                if attempt not in running:
+                    continue
+                if kind == "error":
+                    model, _ = running.pop(attempt)
+                    errors.append(f"{model}: {str(value) or type(value).__name__}")
+                    if not running and remaining:
+                        self.fallbacks_used += 1
+                        logger.warning(f"Chat model failed ({errors[-1]}), falling back to {remaining[0]}")
+                        hedge_at = time.monotonic() + self.hedge_delay(launch())
+                    elif not running:
+                        self.exhausted += 1
+                        raise ModelUnavailable("; ".join(errors))
+                    continue
+                winner = attempt
+                
+            model, winner_task = running.pop(winner)
+            for _, other in running.values():
+                other.cancel()
+            running.clear()
+            self.health(model).wins += 1
+            if hedged and winner != 0:
+                self.hedge_wins += 1
+                
+            # First output decided the race, from here on it's just this model's stream
+            while kind != "done":
+                if kind == "error":
+                    raise value
+                yield value
+                attempt, kind, value = await events.get()
+                while attempt != winner:
+                    attempt, kind, value = await events.get()
+        finally:
+            self.recent_hedged.append(hedged)
+            for _, other in running.values():
+                other.cancel()
+            if winner is not None:
+                winner_task.cancel()
+
+    async def attempt(self, attempt, model, payload, priority, tokens, stream, events, retry):
+        health = self.health(model)
+        started = time.perf_counter()
+        answered = False
+        body = dict(payload, model=model)
+        if stream:
+            body["stream"] = True
+        try:
+            async with self.http.post(
+                self.url, json=body, timeout=self.timeout, priority=priority, tokens=tokens,
+                attempts=None if retry else 1
+            ) as response:
+                metrics.observe("llm_first_byte", time.perf_counter() - started)
+                if response.status == 429:
+                    retry_after = self.http.parse_retry_after(response)
+                    health.rate_limited(self.rate_limit_cooldown if retry_after is None else retry_after)
+                    self.rate_limited += 1
+                if response.status != 200:
+                    error_data = await response.text()
+                    raise ModelRequestError(f"HTTP {response.status}: {error_data[:200]}")
+                if stream:
+                    async for delta in self.iter_stream_deltas(response):
+                        if not answered:
+                            answered = True
+                            health.record_latency(time.perf_counter() - started)
+                        events.put_nowait((attempt, "delta", delta))
+                else:
+                    data = await response.json()
+                    answered = True
+                    health.record_latency(time.perf_counter() - started)
+                    content = (data.get("choices") or [{}])[0].get("message", {}).get("content")
+                    if content:
+                        events.put_nowait((attempt, "delta", content))
+            health.record_success()
+            events.put_nowait((attempt, "done", None))
+        except asyncio.CancelledError:
+            if not answered:
+                # Lost a hedge race: we only know it would have taken at least this long
+                health.record_latency(time.perf_counter() - started)
+            raise
+        except Exception as e:
+            health.record_failure(self.failure_threshold, self.cooldown)
+            events.put_nowait((attempt, "error", e))
+
+    @staticmethod
+    async def iter_stream_deltas(response):
+        # Groq streams OpenAI-style server-sent events, one "data:" line per chunk
+        async for raw_line in response.content:
+            line = raw_line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping malformed stream chunk: {data[:100]}")
+                continue
+            choices = chunk.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+    def stats(self):
+        stats = {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "fallbacks": self.fallbacks_used,
+            "all_models_failed": self.exhausted,
+            "rate_limited_429": self.rate_limited
+        }
+        now = time.monotonic()
+        for model, health in self.models.items():
+            parts = ["healthy" if health.healthy(now) else "cooling down"]
+            if health.latencies:
+                parts.append(f"p50 {health.quantile(0.5) * 1000:.0f}ms, p95 {health.quantile(0.95) * 1000:.0f}ms")
+            parts.append(f"errors {health.error_rate:.0%}, wins {health.wins}/{health.requests}")
+            stats[model] = ", ".join(parts)
+        return stats
+
+def split_message(text, limit=2000):
+    """Split text into Discord-sized chunks without cutting words in half"""
+    chunks = []
+    while len(text) > limit:
+        cut = max(text.rfind("\n", 0, limit), text.rfind(" ", 0, limit))
+        if cut <= 0:
+            cut = limit  # A single huge word, nothing better to do than hard cut
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+class RestBudget:
+    """Estimates Discord rate-limit headroom per route, so cosmetic calls give way to the ones that matter"""
+    # Per-channel limits Discord documents for these routes: (requests, per seconds)
+    ROUTES = {
+        "send": (5, 5.0),
+        "edit": (5, 5.0),
+        "delete": (5, 1.0),
+        "reaction": (1, 0.25)
+    }
+    # (route, when) of the call the current task is about to make. nextcord runs its rate-limit
+    # listeners as tasks created inside the request, so they see the route that ran dry.
+    current_route = contextvars.ContextVar("rest_route", default=None)
+    ROUTE_TAG_TTL = 5.0  # Older tags belong to a call that is long done, not to this event
+
+    def __init__(self, reserve=2, global_per_second=50, fast_path_rate=30, fast_path_guilds=(), max_routes=2000):
+        self.reserve = reserve  # Calls per route kept back for essential traffic
+        self.global_bucket = TokenBucket(global_per_second * 60, capacity=global_per_second)
+        self.fast_path_rate = fast_path_rate  # Messages per minute that make a guild high traffic, 0 = never
+        self.fast_path_guilds = set(fast_path_guilds)  # Always on the fast path
+        self.max_routes = max_routes
+        self.buckets = OrderedDict()  # (kind, channel id) -> TokenBucket, least recently used first
+        self.traffic = {}  # guild id -> [messages per minute, last update], exponentially decayed
+        self.route_blocked = {}  # (kind, channel id) -> time Discord said that bucket resets
+        self.blocked_until = 0.0  # Cosmetics are off everywhere during a global rate limit
+
+        self.essential = 0
+        self.cosmetic_sent = 0
+        self.cosmetic_dropped = defaultdict(int)
+        self.exhausted_routes = 0
+        self.unattributed_events = 0
+        self.global_ratelimits = 0
+
+    def _bucket(self, kind, channel_id):
+        key = (kind, channel_id)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            requests, seconds = self.ROUTES[kind]
+            bucket = self.buckets[key] = TokenBucket(requests * 60 / seconds, capacity=requests)
+            if len(self.buckets) > self.max_routes:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def spend(self, kind, channel_id):
+        """Account for a call that goes out no matter what"""
+        now = time.monotonic()
+        bucket = self._bucket(kind, channel_id)
+        bucket.wait_time(1, now)  # Refill before spending
+        bucket.consume(1)
+        self.global_bucket.wait_time(1, now)
+        self.global_bucket.consume(1)
+        self.essential += 1
+        self.current_route.set(((kind, channel_id), now))
+
+    def allow(self, kind, channel_id, guild_id=None):
+        """Whether a cosmetic call may go out, spends its budget if so"""
+        now = time.monotonic()
+        if self.fast_path(guild_id):
+            reason = "fast_path"
+        elif now < self.blocked_until:
+            reason = "rate_limited"
+        elif now < self.route_blocked.get((kind, channel_id), 0.0):
+            reason = "exhausted"
+        else:
+            bucket = self._bucket(kind, channel_id)
+            reserve = min(self.reserve, bucket.capacity - 1)
+            if bucket.wait_time(1 + reserve, now) > 0 or self.global_bucket.wait_time(1 + self.reserve, now) > 0:
+                reason = "no_headroom"
+            else:
+                bucket.consume(1)
+                self.global_bucket.consume(1)
+                self.cosmetic_sent += 1
+                self.current_route.set(((kind, channel_id), now))
+                return True
+        self.cosmetic_dropped[f"{kind}_{reason}"] += 1
+        return False
+
+    def exhausted(self, reset_after):
+        """Discord says the bucket of the call just made ran dry, only that route waits for the reset"""
+        now = time.monotonic()
+        tag = self.current_route.get()
+        if tag is None or now - tag[1] > self.ROUTE_TAG_TTL:
+            # A call the budget doesn't track, e.g. a command reply
+            self.unattributed_events += 1
+            return
+        route = tag[0]
+        self.exhausted_routes += 1
+        self.route_blocked[route] = max(self.route_blocked.get(route, 0.0), now + reset_after)
+        if len(self.route_blocked) > self.max_routes:
+            self.route_blocked = {key: until for key, until in self.route_blocked.items() if until > now}
+
+    def pressure(self, retry_after):
+        # Global rate limit, every route waits it out
+        self.global_ratelimits += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def note_message(self, guild_id):
+        if guild_id is None or not self.fast_path_rate:
+            return
+        now = time.monotonic()
+        rate, updated = self.traffic.get(guild_id, (0.0, now))
+        # One minute time constant, a steady stream of N per minute settles at N
+        self.traffic[guild_id] = [rate * math.exp((updated - now) / 60.0) + 1.0, now]
+        if len(self.traffic) > self.max_routes:
+            cutoff = now - 600
+            self.traffic = {guild: entry for guild, entry in self.traffic.items() if entry[1] >= cutoff}
+
+    def fast_path(self, guild_id):
+        if guild_id is None:
+            return False
+        if guild_id in self.fast_path_guilds:
+            return True
+        entry = self.traffic.get(guild_id)
+        if entry is None or not self.fast_path_rate:
+            return False
+        rate, updated = entry
+        return rate * math.exp((updated - time.monotonic()) / 60.0) >= self.fast_path_rate
+
+    def stats(self):
+        stats = {
+            "essential_calls": self.essential,
+            "cosmetic_sent": self.cosmetic_sent,
+            "cosmetic_dropped": sum(self.cosmetic_dropped.values()),
+            "fast_path_guilds": sum(1 for guild in set(self.traffic) | self.fast_path_guilds if self.fast_path(guild)),
+            "exhausted_routes": self.exhausted_routes,
+            "unattributed_ratelimits": self.unattributed_events,
+            "global_ratelimits": self.global_ratelimits,
+            "blocked_routes": sum(1 for until in self.route_blocked.values() if until > time.monotonic()),
+            "under_pressure": time.monotonic() < self.blocked_until,
+            "tracked_routes": len(self.buckets)
+        }
+        stats.update({f"dropped_{key}": value for key, value in sorted(self.cosmetic_dropped.items())})
+        return stats
+
+class StreamingReply:
+    """Shows a streamed completion by progressively editing Discord messages"""
+    def __init__(self, channel, first_message=None, edit_interval=1.0, limit=2000, budget=None, guild_id=None):
+        self.channel = channel
+        self.budget = budget  # Intermediate edits are cosmetic, they're skipped without headroom
+        self.guild_id = guild_id
+        self.message = first_message  # Reused for the first tokens, e.g. the "thinking" message
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.text = ""  # Full reply so far
+        self.current = ""  # Part of the reply that belongs to the current message
+        self.shown = None  # What the current message is showing right now
+        self.last_edit = 0.0
+        self.first_token_time = None
+        self.messages = []
+
+    async def feed(self, delta):
+        if not delta:
+            return
+        if self.first_token_time is None:
+            self.first_token_time = time.monotonic()
+        self.text += delta
+        self.current += delta
+        
+        # Roll over to a new message at the character limit, on a word boundary
+        while len(self.current) > self.limit:
+            head = split_message(self.current, self.limit)[0]
+            self.current = self.current[len(head):].lstrip()
+            await self._show(head)
+            self.message = None
+            self.shown = None
+        
+        if not self.current.strip():
+            return
+        if self.shown is None:
+            # The first tokens of each message go out immediately
+            await self._show(self.current)
+        elif time.monotonic() - self.last_edit >= self.edit_interval:
+            # The rest at a rate-limit-safe cadence, and only while there's room to spare
+            if self.budget is None or self.budget.allow("edit", self.channel.id, self.guild_id):
+                await self._show(self.current, essential=False)
+            else:
+                self.last_edit = time.monotonic()  # Skipped this tick, check again next interval
+
+    async def finish(self):
+        if self.current.strip() and self.shown != self.current:
+            await self._show(self.current)
+        return self.text
+
+    async def _show(self, content, essential=True):
+        if self.budget is not None and essential:
+            self.budget.spend("send" if self.message is None else "edit", self.channel.id)
+        if self.message is None:
+            with metrics.timer("discord_send"):
+                self.message = await self.channel.send(content)
+        else:
+            with metrics.timer("discord_edit"):
+                await self.message.edit(content=content)
+        if self.message not in self.messages:
+            self.messages.append(self.message)
+        self.shown = content
+        self.last_edit = time.monotonic()
+
+class LoopLagMonitor:
+    """Measures how long the event loop is blocked by oversleeping a short timer"""
+    def __init__(self, interval=0.5, warn_threshold=0.25):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.avg_lag = 0.0  # Exponentially weighted
+        self.total_blocked = 0.0
+        self.slow_ticks = 0
+        self.samples = 0
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - start - self.interval)
+            self.record(lag)
+
+    def record(self, lag):
+        metrics.observe("event_loop_lag", lag)
+        self.samples += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.avg_lag = lag if self.samples == 1 else self.avg_lag * 0.9 + lag * 0.1
+        self.total_blocked += lag
+        if lag > self.warn_threshold:
+            self.slow_ticks += 1
+            logger.warning(f"Event loop was blocked for {lag * 1000:.0f}ms")
+
+    def stats(self):
+        return {
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "avg_lag_ms": round(self.avg_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "total_blocked_s": round(self.total_blocked, 2),
+            "slow_ticks": self.slow_ticks,
+            "samples": self.samples
+        }
+
+class TTSCache:
+    """Content-addressed cache of synthesized speech: in-memory LRU in front of a disk store"""
+    def __init__(self, directory, memory_limit=32 * 1024 * 1024, disk_limit=512 * 1024 * 1024):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict()  # key -> audio bytes, most recently used last
+        self.memory_bytes = 0
+        self.disk_index = None  # key -> size, built lazily from the directory
+        self.disk_bytes = 0
+        self.lock = threading.Lock()  # Disk methods run in worker threads
+        
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(text, lang, slow):
+        return hashlib.sha256(f"{lang}|{int(slow)}|{text}".encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def get_memory(self, key):
+        with self.lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+            return audio
+
+    def get_disk(self, key):
+        """Blocking, call from a worker thread"""
+        self._ensure_index()
+        try:
+            with open(self.path_for(key), "rb") as file:
+                audio = file.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.disk_hits += 1
+            if key in self.disk_index:
+                self.disk_index.move_to_end(key)
+            self._remember(key, audio)
+        return audio
+
+    def put(self, key, audio):
+        """Blocking, call from a worker thread"""
+        self._ensure_index()
+        path = self.path_for(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(audio)
+        os.replace(tmp_path, path)
+        
+        with self.lock:
+            self.disk_bytes += len(audio) - self.disk_index.pop(key, 0)
+            self.disk_index[key] = len(audio)
+            self._remember(key, audio)
+            evicted = []
+            while self.disk_bytes > self.disk_limit and len(self.disk_index) > 1:
+                old_key, size = self.disk_index.popitem(last=False)
+                self.disk_bytes -= size
+                evicted.append(old_key)
+            self.evictions += len(evicted)
+        for old_key in evicted:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path_for(old_key))
+
+    def _remember(self, key, audio):
+        # Caller holds the lock
+        self.memory_bytes += len(audio) - len(self.memory.pop(key, b""))
+        self.memory[key] = audio
+        while self.memory_bytes > self.memory_limit and len(self.memory) > 1:
+            _, old_audio = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old_audio)
+
+    def _ensure_index(self):
+        if self.disk_index is not None:
+            return
+        with self.lock:
+            if self.disk_index is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".mp3"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-len(".mp3")], stat.st_size))
+            # Oldest first, so eviction starts with the least recently written audio
+            self.disk_index = OrderedDict((key, size) for _, key, size in sorted(entries))
+            self.disk_bytes = sum(self.disk_index.values())
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": f"{(self.hits + self.disk_hits) / lookups:.1%}" if lookups else "n/a",
+            "memory_entries": len(self.memory),
+            "memory_mb": round(self.memory_bytes / 1024 / 1024, 2),
+            "disk_entries": len(self.disk_index) if self.disk_index is not None else 0,
+            "disk_mb": round(self.disk_bytes / 1024 / 1024, 2),
+            "evictions": self.evictions
+        }
+
+class InMemoryFFmpegAudio(FFmpegPCMAudio):
+    """FFmpeg audio source fed from encoded bytes over a pipe instead of a file"""
+    def __init__(self, audio, **kwargs):
+        super().__init__(io.BytesIO(audio), pipe=True, **kwargs)
+
+    def _pipe_writer(self, source):
+        # The stock writer terminates FFmpeg as soon as the input is consumed, which can clip
+        # the end of short clips. Closing stdin lets FFmpeg drain what it has buffered.
+        try:
+            while self._process:
+                data = source.read(8192)
+                if not data:
+                    break
+                self._stdin.write(data)
+        except Exception:
+            logger.debug("Write to FFmpeg stdin failed, this is probably not a problem", exc_info=True)
+        finally:
+            with contextlib.suppress(Exception):
+                self._stdin.close()
+
+    def cleanup(self):
+        # Popen.communicate(), used when FFmpeg is slow to die, trips over the stdin we already closed
+        stdin = getattr(self._process, "stdin", None)
+        if stdin is not None and stdin.closed:
+            self._process.stdin = None
+        super().cleanup()
+
+class Utterance:
+    """One queued piece of speech: a stream of encoded clips and the task producing them"""
+    def __init__(self, clips, producer, priority):
+        self.clips = clips
+        self.producer = producer
+        self.priority = priority
+        self.done = asyncio.get_running_loop().create_future()  # True if played, False if dropped
+
+    def finish(self, played):
+        self.producer.cancel()
+        if not self.done.done():
+            self.done.set_result(played)
+
+class GuildPlayback:
+    """Per-guild voice playback scheduler, driven by the voice client's after callback"""
+    PRIORITY_SYSTEM = 0  # Greetings, farewells, idle nudges
+    PRIORITY_REPLY = 1
+    
+    def __init__(self, vc, executable="ffmpeg"):
+        self.vc = vc
+        self.executable = executable
+        self.pending = []  # Heap of (priority, sequence, utterance)
+        self.sequence = itertools.count()
+        self.current = None
+        self.current_task = None
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.worker = asyncio.create_task(self.run())
+
+    def enqueue(self, utterance, barge_in=False):
+        if barge_in:
+            # Drop everything that isn't more important than the newcomer, including what is playing
+            kept = []
+            for entry in self.pending:
+                if entry[2].priority < utterance.priority:
+                    kept.append(entry)
+                else:
+                    entry[2].finish(False)
+            self.pending = kept
+            heapq.heapify(self.pending)
+            if self.current and self.current.priority >= utterance.priority:
+                self.current_task.cancel()
+                
+        heapq.heappush(self.pending, (utterance.priority, next(self.sequence), utterance))
+        self.idle.clear()
+        self.wakeup.set()
+        return utterance.done
+
+    def queue_depth(self):
+        return len(self.pending) + (1 if self.current else 0)
+
+    async def drain(self):
+        """Wait until everything queued so far has played"""
+        await self.idle.wait()
+
+    async def run(self):
+        while True:
+            if not self.pending:
+                self.idle.set()
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+                
+            _, _, utterance = heapq.heappop(self.pending)
+            self.current = utterance
+            self.current_task = asyncio.create_task(self.play_utterance(utterance))
+            played = False
+            try:
+                # wait() instead of awaiting directly so a barge-in doesn't cancel the worker itself
+                await asyncio.wait([self.current_task])
+                if self.current_task.cancelled():
+                    played = False
+                elif self.current_task.exception():
+                    error = self.current_task.exception()
+                    logger.error(f"Error during voice playback: {str(error)}", exc_info=error)
+                else:
+                    played = True
+            finally:
+                utterance.finish(played)
+                self.current = None
+                self.current_task = None
+
+    async def play_utterance(self, utterance):
+        try:
+            while True:
+                audio = await utterance.clips.get()
+                if audio is None or not self.vc.is_connected():
+                    break
+                await self.play_clip(audio)
+        except asyncio.CancelledError:
+            if self.vc.is_playing():
+                self.vc.stop()
+            raise
+
+    async def play_clip(self, audio):
+        finished = asyncio.get_running_loop().create_future()
+        
+        def after(error):
+            if error:
+                logger.error(f"Error during playback: {str(error)}")
+            # Called from the audio player thread
+            finished.get_loop().call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+            
+        # Encoded audio goes straight to FFmpeg's stdin, nothing touches the disk
+        with metrics.timer("ffmpeg_startup"):
+            source = InMemoryFFmpegAudio(audio, executable=self.executable)
+        self.vc.play(source, after=after)
+        await finished
+
+    def close(self):
+        self.worker.cancel()
+        if self.current_task:
+            self.current_task.cancel()
+        for _, _, utterance in self.pending:
+            utterance.finish(False)
+        self.pending = []
+        if self.current:
+            self.current.finish(False)
+        self.idle.set()
+
+ROLE_NAMES = {"u": "user", "a": "assistant", "s": "system"}
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token for English, plus the per-message framing overhead
+    return len(text) // 4 + 4
+
+class ConversationContext:
+    """Per-channel chat history capped by estimated tokens, older turns get folded into a summary"""
+    def __init__(self, max_tokens=3000, max_pending_tokens=6000):
+        self.max_tokens = max_tokens
+        self.max_pending_tokens = max_pending_tokens
+        self.turns = deque()  # (message, estimated tokens), estimated once when added
+        self.turn_tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.evicted = deque()  # Turns pushed out of the window, waiting to be summarized
+        self.evicted_tokens = 0
+        self.summary_task = None
+
+    def __len__(self):
+        return len(self.turns)
+
+    def append(self, role, content):
+        tokens = estimate_tokens(content)
+        self.turns.append(({"role": role, "content": content}, tokens))
+        self.turn_tokens += tokens
+        
+        # Always keep the newest turn, even if it alone is over budget
+        while self.turn_tokens + self.summary_tokens > self.max_tokens and len(self.turns) > 1:
+            message, tokens = self.turns.popleft()
+            self.turn_tokens -= tokens
+            self.evicted.append((message, tokens))
+            self.evicted_tokens += tokens
+        self._cap_evicted()
+
+    def messages(self):
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+        messages.extend(message for message, _ in self.turns)
+        return messages
+
+    def needs_summary(self):
+        return bool(self.evicted) and (self.summary_task is None or self.summary_task.done())
+
+    def take_evicted(self):
+        batch = list(self.evicted)
+        self.evicted.clear()
+        self.evicted_tokens = 0
+        return batch
+
+    def restore_evicted(self, batch):
+        # Summarizing failed, retry these with the next batch
+        self.evicted.extendleft(reversed(batch))
+        self.evicted_tokens += sum(tokens for _, tokens in batch)
+        self._cap_evicted()
+
+    def set_summary(self, summary):
+        self.summary = summary.strip()
+        self.summary_tokens = estimate_tokens(self.summary) if self.summary else 0
+
+    def clear(self):
+        if self.summary_task and not self.summary_task.done():
+            self.summary_task.cancel()
+        self.turns.clear()
+        self.turn_tokens = 0
+        self.evicted.clear()
+        self.evicted_tokens = 0
+        self.set_summary("")
+
+    def to_record(self):
+        # Compact per-turn records: one-letter role, content, cached token estimate
+        return {
+            "s": self.summary,
+            "t": [[message["role"][0], message["content"], tokens] for message, tokens in self.turns],
+            "e": [[message["role"][0], message["content"], tokens] for message, tokens in self.evicted]
+        }
+
+    @classmethod
+    def from_record(cls, record, **kwargs):
+        context = cls(**kwargs)
+        context.set_summary(record.get("s", ""))
+        for role, content, tokens in record.get("t", []):
+            context.turns.append(({"role": ROLE_NAMES[role], "content": content}, tokens))
+            context.turn_tokens += tokens
+        for role, content, tokens in record.get("e", []):
+            context.evicted.append(({"role": ROLE_NAMES[role], "content": content}, tokens))
+            context.evicted_tokens += tokens
+        return context
+
+    def _cap_evicted(self):
+        # If summaries keep failing, the oldest turns are simply forgotten
+        while self.evicted_tokens > self.max_pending_tokens and len(self.evicted) > 1:
+            _, tokens = self.evicted.popleft()
+            self.evicted_tokens -= tokens
+
+class StateBackend(ABC):
+    """Key-value state shared by every bot process, values are strings and keys can expire"""
+    shared = False  # Whether other processes see what this one writes
+
+    @abstractmethod
+    async def get(self, key):
+        """The value, or None if the key doesn't exist or has expired"""
+
+    @abstractmethod
+    async def set(self, key, value, ttl=None, only_if_absent=False):
+        """Returns False when only_if_absent is set and the key already exists"""
+
+    async def set_many(self, items, ttl=None):
+        for key, value in items:
+            await self.set(key, value, ttl=ttl)
+
+    @abstractmethod
+    async def delete(self, key):
+        pass
+
+    async def lease(self, name, owner, ttl):
+        """Claim a named lease for ttl seconds, exactly one caller gets it until it expires"""
+        return await self.set(f"lease:{name}", owner, ttl=ttl, only_if_absent=True)
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+class LocalStateBackend(StateBackend):
+    """State in this process only, all a single bot process needs"""
+    def __init__(self, sweep_every=1000):
+        self.values = {}  # key -> (value, expires at or None)
+        self.sweep_every = sweep_every
+        self.writes = 0
+        self.commands = 0
+
+    def _entry(self, key, now):
+        entry = self.values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self.values[key]
+            return None
+        return entry
+
+    async def get(self, key):
+        self.commands += 1
+        entry = self._entry(key, time.monotonic())
+        return entry[0] if entry else None
+
+    async def set(self, key, value, ttl=None, only_if_absent=False):
+        self.commands += 1
+        now = time.monotonic()
+        if only_if_absent and self._entry(key, now) is not None:
+            return False
+        self.values[key] = (value, now + ttl if ttl else None)
+        self.writes += 1
+        if self.writes % self.sweep_every == 0:
+            # Expired leases are never read again, drop them now and then
+            self.values = {key: entry for key, entry in self.values.items() if entry[1] is None or entry[1] > now}
+        return True
+
+    async def delete(self, key):
+        self.commands += 1
+        self.values.pop(key, None)
+
+    def stats(self):
+        return {"backend": "local", "keys": len(self.values), "commands": self.commands}
+
+class RedisStateBackend(StateBackend):
+    """State on a Redis-compatible server, commands are pipelined over one connection"""
+    shared = True
+
+    def __init__(self, url="redis://127.0.0.1:6379/0", prefix="chatbot:", connect_timeout=5.0, command_timeout=5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.prefix = prefix  # Lets several bots share one server
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.pending = deque()  # Reply futures, in the order the commands were sent
+        self.connect_lock = asyncio.Lock()
+        
+        self.connects = 0
+        self.commands = 0
+        self.errors = 0
+
+    async def _connect(self):
+        if self.writer is not None:
+            return
+        async with self.connect_lock:
+            if self.writer is not None:
+                return
+            try:
+                reader, writer = await asyncio.wait_for(self._open(), timeout=self.connect_timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, StateBackendError) as e:
+                self.errors += 1
+                raise StateBackendError(f"can't connect to {self.host}:{self.port}: {str(e) or type(e).__name__}")
+            # Only published once the handshake is done, so no command can run before AUTH and SELECT
+            self.reader, self.writer = reader, writer
+            self.read_task = asyncio.create_task(self._read_replies(reader))
+            self.connects += 1
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        handshake = []
+        if self.password:
+            handshake.append(("AUTH", self.password))
+        if self.db:
+            handshake.append(("SELECT", self.db))
+        try:
+            if handshake:
+                writer.write(b"".join(self._encode(args) for args in handshake))
+                for args in handshake:
+                    reply = await self._read_reply(reader)
+                    if isinstance(reply, StateBackendError):
+                        raise StateBackendError(f"{args[0]} failed: {reply}")
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def execute(self, *args):
+        return (await self.execute_many([args]))[0]
+
+    async def execute_many(self, commands):
+        """Send every command in one write, replies come back in order"""
+        await self._connect()
+        loop = asyncio.get_running_loop()
+        futures = []
+        payload = bytearray()
+        for args in commands:
+            payload += self._encode(args)
+            future = loop.create_future()
+            self.pending.append(future)
+            futures.append(future)
+        self.writer.write(payload)
+        self.commands += len(commands)
+        gathered = asyncio.gather(*futures)
+        # Shielded, nobody awaits it again after a timeout or cancellation, so _reset() would fail it unobserved
+        gathered.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            replies = await asyncio.wait_for(asyncio.shield(gathered), timeout=self.command_timeout)
+        except asyncio.TimeoutError:
+            # Replies can't be matched to commands anymore, start over on a fresh connection
+            self.errors += 1
+            self._reset(StateBackendError("command timed out"))
+            raise StateBackendError(f"{commands[0][0]} timed out after {self.command_timeout}s")
+        for reply in replies:
+            if isinstance(reply, StateBackendError):
+                raise reply
+        return replies
+
+    @staticmethod
+    def _encode(args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                reply = await self._read_reply(reader)
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_result(reply)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            self._reset(StateBackendError(f"connection lost: {str(e) or type(e).__name__}"))
+
+    async def _read_reply(self, reader):
+        line = await reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            # Returned rather than raised, only this command failed
+            return StateBackendError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            size = int(body)
+            if size < 0:
+                return None
+            return (await reader.readexactly(size + 2))[:-2].decode()
+        if kind == b"*":
+            size = int(body)
+            if size < 0:
+                return None
+            return [await self._read_reply(reader) for _ in range(size)]
+        raise ConnectionError(f"unexpected reply {line[:20]!r}")
+
+    def _reset(self, error):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        if self.read_task is not None and self.read_task is not asyncio.current_task():
+            self.read_task.cancel()
+        self.read_task = None
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def get(self, key):
+        return await self.execute("GET", self.prefix + key)
+
+    async def set(self, key, value, ttl=None, only_if_absent=False):
+        return await self.execute(*self._set_args(key, value, ttl, only_if_absent)) == "OK"
+
+    async def set_many(self, items, ttl=None):
+        commands = [self._set_args(key, value, ttl) for key, value in items]
+        if commands:
+            await self.execute_many(commands)
+
+    def _set_args(self, key, value, ttl=None, only_if_absent=False):
+        args = ["SET", self.prefix + key, value]
+        if ttl:
+            args += ["PX", max(1, int(ttl * 1000))]
+        if only_if_absent:
+            args.append("NX")
+        return args
+
+    async def delete(self, key):
+        await self.execute("DEL", self.prefix + key)
+
+    async def close(self):
+        writer = self.writer
+        if writer is not None:
+            self._reset(StateBackendError("backend closed"))
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+
+    def stats(self):
+        return {
+            "backend": f"redis {self.host}:{self.port}/{self.db}",
+            "connected": self.writer is not None,
+            "connects": self.connects,
+            "commands": self.commands,
+            "errors": self.errors,
+            "pending_replies": len(self.pending)
+        }
+
+class HistoryStore:
+    """Conversation contexts with a bounded in-memory working set, cold channels live in SQLite or a shared backend"""
+    def __init__(self, path, run_io, context_factory, max_active=1000, flush_interval=5.0, backend=None):
+        self.path = path
+        self.run_io = run_io
+        # A shared backend replaces SQLite, each channel is served by one worker at a time (its guild's shard)
+        self.backend = backend
+        self.context_factory = context_factory
+        self.max_active = max_active
+        self.flush_interval = flush_interval
+        self.active = OrderedDict()  # channel id -> context, most recently used last
+        self.spilled = {}  # Evicted from the working set but not written yet
+        self.pinned = {}  # channel id -> turns or summaries still holding its context, never evicted
+        self.dirty = set()
+        self.db = None
+        self.db_lock = threading.Lock()  # The connection is shared by the I/O pool threads
+        
+        self.loads = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    async def get(self, channel_id, create=True):
+        context = self.active.get(channel_id)
+        if context is not None:
+            self.active.move_to_end(channel_id)
+            return context
+            
+        context = self.spilled.get(channel_id)
+        if context is None:
+            record = await self._load_record(channel_id)
+            if channel_id in self.active:
+                # Someone else woke the channel up while we were reading
+                return self.active[channel_id]
+            if record is not None:
+                context = self.context_factory(record)
+                self.loads += 1
+            elif create:
+                context = self.context_factory(None)
+            else:
+                return None
+        self._activate(channel_id, context)
+        return context
+
+    async def acquire(self, channel_id):
+        """Context for a turn, it stays in the working set until release() so no newer copy can be loaded meanwhile"""
+        self.pin(channel_id)
+        try:
+            return await self.get(channel_id)
+        except BaseException:
+            self.release(channel_id)
+            raise
+
+    def pin(self, channel_id):
+        self.pinned[channel_id] = self.pinned.get(channel_id, 0) + 1
+
+    def release(self, channel_id):
+        holders = self.pinned.pop(channel_id, 0) - 1
+        if holders > 0:
+            self.pinned[channel_id] = holders
+        else:
+            self._evict()
+
+    def mark_dirty(self, channel_id, context):
+        current = self.active.get(channel_id)
+        if current is None:
+            current = self.spilled.get(channel_id)
+        if current is None:
+            self._activate(channel_id, context)
+        elif current is not context:
+            # A copy that was evicted and reloaded behind the caller's back, writing it would lose newer turns
+            logger.warning(f"Dropped a write to a stale conversation context in channel {channel_id}")
+            return
+        self.dirty.add(channel_id)
+
+    def _activate(self, channel_id, context):
+        self.spilled.pop(channel_id, None)
+        self.active[channel_id] = context
+        self.active.move_to_end(channel_id)
+        self._evict()
+
+    def _evict(self):
+        excess = len(self.active) - self.max_active
+        if excess <= 0:
+            return
+        # Held channels are skipped, the working set runs over until they are released
+        for old_id in list(itertools.islice((c for c in self.active if c not in self.pinned), excess)):
+            old_context = self.active.pop(old_id)
+            if old_id in self.dirty:
+                # Kept only until the next flush writes it out
+                self.spilled[old_id] = old_context
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Write every changed channel in one transaction"""
+        if not self.dirty:
+            return
+        now = time.time()
+        batch = []
+        for channel_id in self.dirty:
+            # Not `or`: a cleared context is empty and falsy, but still has to be written
+            context = self.active.get(channel_id)
+            if context is None:
+                context = self.spilled.get(channel_id)
+            if context is not None:
+                batch.append((channel_id, json.dumps(context.to_record(), separators=(",", ":")), now))
+        self.dirty.clear()
+        
+        try:
+            await self._write_records(batch)
+        except Exception as e:
+            logger.error(f"Error flushing conversation history: {str(e)}", exc_info=True)
+            self.dirty.update(channel_id for channel_id, _, _ in batch)
+            return
+            
+        self.flushes += 1
+        self.rows_written += len(batch)
+        for channel_id, _, _ in batch:
+            if channel_id not in self.dirty:
+                self.spilled.pop(channel_id, None)
+
+    async def close(self):
+        await self.flush()
+        await self.run_io(self._close)
+
+    async def _load_record(self, channel_id):
+        if self.backend is None:
+            return await self.run_io(self._load, channel_id)
+        record = await self.backend.get(f"history:{channel_id}")
+        return json.loads(record) if record else None
+
+    async def _write_records(self, batch):
+        if self.backend is None:
+            await self.run_io(self._write, batch)
+        else:
+            await self.backend.set_many((f"history:{channel_id}", record) for channel_id, record, _ in batch)
+
+    def _connect(self):
+        # Caller holds the lock
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "channel_id TEXT PRIMARY KEY, record TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self.db
+
+    def _load(self, channel_id):
+        with self.db_lock:
+            row = self._connect().execute(
+                "SELECT record FROM history WHERE channel_id = ?", (channel_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, batch):
+        with self.db_lock:
+            db = self._connect()
+            with db:
+                db.executemany(
+                    "INSERT INTO history (channel_id, record, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(channel_id) DO UPDATE SET record = excluded.record, updated_at = excluded.updated_at",
+                    batch
+                )
+
+    def _close(self):
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def stats(self):
+        return {
+            "active_channels": len(self.active),
+            "max_active_channels": self.max_active,
+            "pending_spill": len(self.spilled),
+            "pinned_channels": len(self.pinned),
+            "dirty_channels": len(self.dirty),
+            "lazy_loads": self.loads,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written
+        }
+
+class PreferencesStore:
+    """Per-user preferences kept in memory, written back atomically and debounced"""
+    def __init__(self, path, run_io, flush_delay=2.0, backend=None):
+        self.path = path
+        self.run_io = run_io
+        self.backend = backend  # Shared between processes, read and written through instead of the file
+        self.flush_delay = flush_delay
+        self.records = {}
+        self.loaded = False
+        self.load_lock = asyncio.Lock()
+        self.flush_task = None
+        self.dirty = False
+        self.version = 0
+        self.written_version = 0
+        self.write_lock = threading.Lock()
+        
+        self.updates = 0
+        self.writes = 0
+
+    async def ensure_loaded(self):
+        # The file is only read the first time a preference is actually needed
+        if self.loaded:
+            return
+        async with self.load_lock:
+            if not self.loaded:
+                self.records = await self.run_io(self._read)
+                self.loaded = True
+
+    async def get(self, user_id, key, default=None):
+        if self.backend is not None:
+            record = await self.backend.get(self._shared_key(user_id, key))
+            return json.loads(record) if record else default
+        await self.ensure_loaded()
+        return self.records.get(user_id, {}).get(key, default)
+
+    async def set(self, user_id, key, value):
+        if self.backend is not None:
+            # One key per preference, a whole-user read-modify-write would lose concurrent updates from other workers
+            await self.backend.set(self._shared_key(user_id, key), json.dumps(value))
+            self.updates += 1
+            self.writes += 1
+            return
+        await self.ensure_loaded()
+        self.records.setdefault(user_id, {})[key] = value
+        self.updates += 1
+        self.version += 1
+        self.dirty = True
+        # A burst of changes is coalesced into one write after the delay
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    @staticmethod
+    def _shared_key(user_id, key):
+        return f"prefs:{user_id}:{key}"
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        # Snapshot on the loop so the worker thread never sees a dict being mutated
+        snapshot = {user_id: dict(prefs) for user_id, prefs in self.records.items()}
+        version = self.version
+        self.dirty = False
+        try:
+            await self.run_io(self._write, snapshot, version)
+        except Exception as e:
+            logger.error(f"Error saving preferences: {str(e)}", exc_info=True)
+            self.dirty = True
+
+    async def close(self):
+        if self.flush_task and not self.flush_task.done():
+            self.flush_task.cancel()
+        await self.flush()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write(self, snapshot, version):
+        with self.write_lock:
+            # A write cancelled on the loop side may still finish here, never let an older snapshot win
+            if version <= self.written_version:
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(snapshot, file)
+                file.flush()
+                os.fsync(file.fileno())
+            # Atomic on POSIX and Windows, a crash leaves either the old or the new file
+            os.replace(tmp_path, self.path)
+            self.written_version = version
+            self.writes += 1
+
+class IdleScheduler:
+    """Deadline-ordered idle tracking, only channels that are actually due get looked at"""
+    def __init__(self, idle_after=600, expire_after=1800):
+        self.idle_after = idle_after
+        self.expire_after = expire_after
+        self.heap = []  # (deadline, channel id), at most one entry per tracked channel
+        self.last_activity = {}  # channel id -> last activity time, the source of truth
+        self.wakeup = asyncio.Event()
+        self.nudges_due = 0
+        self.expired = 0
+
+    def touch(self, channel_id, now=None):
+        now = time.time() if now is None else now
+        armed = channel_id in self.last_activity
+        self.last_activity[channel_id] = now
+        if not armed:
+            heapq.heappush(self.heap, (now + self.idle_after, channel_id))
+            if self.heap[0][1] == channel_id:
+                self.wakeup.set()
+        # Already armed channels are re-armed lazily when their old deadline comes up
+
+    def forget(self, channel_id):
+        self.last_activity.pop(channel_id, None)
+
+    def time_until_next(self, now=None):
+        if not self.heap:
+            return None
+        now = time.time() if now is None else now
+        return max(0.0, self.heap[0][0] - now)
+
+    def pop_due(self, now=None):
+        """(channel id, last activity) whose idle deadline has passed, each one is untracked until its next activity"""
+        now = time.time() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, channel_id = heapq.heappop(self.heap)
+            last = self.last_activity.get(channel_id)
+            if last is None:
+                continue
+            deadline = last + self.idle_after
+            if deadline > now:
+                # There was activity since this entry was armed
+                heapq.heappush(self.heap, (deadline, channel_id))
+                continue
+            del self.last_activity[channel_id]
+            if now - last < self.expire_after:
+                due.append((channel_id, last))
+                self.nudges_due += 1
+            else:
+                self.expired += 1
+        return due
+
+    def stats(self):
+        return {
+            "tracked_channels": len(self.last_activity),
+            "armed_timers": len(self.heap),
+            "next_due_s": round(self.time_until_next(), 1) if self.heap else "n/a",
+            "nudges_due": self.nudges_due,
+            "expired": self.expired
+        }
+
+class TypingManager:
+    """One typing indicator per channel, shared by everything working there and stopped when the last one is done"""
+    def __init__(self):
+        self.channels = {}  # channel id -> [holders, typing task]
+        self.loops_started = 0
+        self.peak_holders = 0
+
+    @contextlib.contextmanager
+    def hold(self, channel):
+        self.acquire(channel)
+        try:
+            yield
+        finally:
+            self.release(channel)
+
+    def acquire(self, channel):
+        entry = self.channels.get(channel.id)
+        if entry is None:
+            entry = self.channels[channel.id] = [0, asyncio.create_task(self.run(channel))]
+            self.loops_started += 1
+        entry[0] += 1
+        self.peak_holders = max(self.peak_holders, entry[0])
+
+    def release(self, channel):
+        entry = self.channels.get(channel.id)
+        if entry is None:
+            return
+        entry[0] -= 1
+        if entry[0] <= 0:
+            entry[1].cancel()
+            del self.channels[channel.id]
+
+    async def run(self, channel):
+        try:
+            # nextcord re-triggers the indicator every few seconds for as long as the context is open
+            async with channel.typing():
+                await asyncio.get_running_loop().create_future()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error in typing indicator: {str(e)}")
+
+    def close(self):
+        for _, task in self.channels.values():
+            task.cancel()
+        self.channels.clear()
+
+    def stats(self):
+        return {
+            "typing_channels": len(self.channels),
+            "typing_holders": sum(holders for holders, _ in self.channels.values()),
+            "peak_holders_per_channel": self.peak_holders,
+            "typing_loops_started": self.loops_started
+        }
+
+class InboundScheduler:
+    """Admission control and fair work slots for incoming messages, round-robin across guilds, then users"""
+    def __init__(self, workers=8, max_per_user=6, max_per_guild=30, max_outstanding=200,
+                 defer_notice_depth=8, notice_cooldown=30.0):
+        self.workers = workers
+        self.max_per_user = max_per_user
+        self.max_per_guild = max_per_guild
+        self.max_outstanding = max_outstanding
+        self.defer_notice_depth = defer_notice_depth  # Queued jobs before waiting messages get a visible marker
+        self.notice_cooldown = notice_cooldown  # Seconds between shed notices in one channel
+        self.active = 0
+        self.queued = 0
+        self.lanes = OrderedDict()  # guild -> OrderedDict(user -> deque of waiting futures)
+        self.outstanding = 0  # Admitted messages whose turn hasn't finished yet
+        self.per_guild = {}
+        self.per_user = {}
+        self.last_notice = {}  # channel id -> monotonic time of the last shed notice
+
+        self.admitted = 0
+        self.shed = {"user": 0, "guild": 0, "full": 0}
+        self.deferred = 0
+        self.peak_queued = 0
+
+    @staticmethod
+    def keys(message):
+        # DMs get a lane per user, so they can't crowd each other out either
+        guild = message.guild.id if message.guild else f"dm:{message.author.id}"
+        return guild, message.author.id
+
+    def admit(self, message):
+        """Count a message against its user, guild and the global limit, returns why it was shed or None"""
+        guild, user = self.keys(message)
+        if self.per_user.get(user, 0) >= self.max_per_user:
+            reason = "user"
+        elif self.per_guild.get(guild, 0) >= self.max_per_guild:
+            reason = "guild"
+        elif self.outstanding >= self.max_outstanding:
+            reason = "full"
+        else:
+            self.per_user[user] = self.per_user.get(user, 0) + 1
+            self.per_guild[guild] = self.per_guild.get(guild, 0) + 1
+            self.outstanding += 1
+            self.admitted += 1
+            return None
+        self.shed[reason] += 1
+        return reason
+
+    def release(self, message):
+        guild, user = self.keys(message)
+        for counts, key in ((self.per_user, user), (self.per_guild, guild)):
+            if counts.get(key, 0) <= 1:
+                counts.pop(key, None)
+            else:
+                counts[key] -= 1
+        self.outstanding = max(0, self.outstanding - 1)
+
+    def should_notify(self, channel_id):
+        # Under a flood the notices themselves would pile up, one per channel per cooldown is plenty
+        now = time.monotonic()
+        if now - self.last_notice.get(channel_id, float("-inf")) < self.notice_cooldown:
+            return False
+        self.last_notice[channel_id] = now
+        if len(self.last_notice) > 1000:
+            cutoff = now - self.notice_cooldown
+            self.last_notice = {key: at for key, at in self.last_notice.items() if at >= cutoff}
+        return True
+
+    def congested(self):
+        return self.queued >= self.defer_notice_depth
+
+    @contextlib.asynccontextmanager
+    async def slot(self, message):
+        guild, user = self.keys(message)
+        future = asyncio.get_running_loop().create_future()
+        self.lanes.setdefault(guild, OrderedDict()).setdefault(user, deque()).append(future)
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        self._dispatch()
+        try:
+            with metrics.timer("inbound_queue_wait"):
+                await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Handed a slot just as we got cancelled
+                self._release()
+            else:
+                self.queued -= 1
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.lanes and self.active < self.workers:
+            guild, users = next(iter(self.lanes.items()))
+            user, futures = next(iter(users.items()))
+            future = futures.popleft()
+            # Whoever just got served goes to the back, both among users and among guilds
+            if futures:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            if users:
+                self.lanes.move_to_end(guild)
+            else:
+                del self.lanes[guild]
+            if future.done():
+                continue  # Cancelled while waiting, already uncounted
+            self.queued -= 1
+            self.active += 1
+            future.set_result(None)
+
+    def stats(self):
+        return {
+            "queued_jobs": self.queued,
+            "active_jobs": self.active,
+            "workers": self.workers,
+            "waiting_guilds": len(self.lanes),
+            "outstanding_messages": self.outstanding,
+            "peak_queued": self.peak_queued,
+            "admitted": self.admitted,
+            "shed_user_limit": self.shed["user"],
+            "shed_guild_limit": self.shed["guild"],
+            "shed_queue_full": self.shed["full"],
+            "deferred": self.deferred
+        }
+
+class ChannelInbox:
+    """Messages for one channel waiting to be turned into a single chat turn"""
+    def __init__(self):
+        self.pending = []  # (message, text) not yet handed to a generation
+        self.arrived = asyncio.Event()
+        self.worker = None
+        self.generation = None
+        self.replying = False  # Once the reply is visible the generation can't be superseded anymore
+
+    def superseded_by_new_message(self):
+        return self.generation is not None and not self.generation.done() and not self.replying
+
+    def start_replying(self):
+        self.replying = True
+
+class SpokenMessage:
+    """Stands in for a Discord message when a turn was spoken in a voice channel"""
+    def __init__(self, channel, author, guild):
+        self.channel = channel
+        self.author = author
+        self.guild = guild
+
+class TranscriptCache:
+    """Transcriptions keyed by audio content hash or attachment id, with a TTL and an LRU bound, persisted to SQLite"""
+    def __init__(self, path, run_io, max_entries=5000, ttl=7 * 24 * 3600):
+        self.path = path
+        self.run_io = run_io
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (text, created), most recently used last
+        self.loaded = False
+        self.load_lock = asyncio.Lock()
+        self.inflight = {}  # key -> task, so concurrent requests for one clip share a single upload
+        self.db = None
+        self.db_lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    async def ensure_loaded(self):
+        if self.loaded:
+            return
+        async with self.load_lock:
+            if not self.loaded:
+                rows = await self.run_io(self._load, time.time() - self.ttl, self.max_entries)
+                for key, text, created in rows:
+                    self.entries[key] = (text, created)
+                self.loaded = True
+
+    async def get(self, key):
+        await self.ensure_loaded()
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    async def put(self, text, *keys):
+        await self.ensure_loaded()
+        now = time.time()
+        for key in keys:
+            self.entries[key] = (text, now)
+            self.entries.move_to_end(key)
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            evicted.append(self.entries.popitem(last=False)[0])
+        self.evictions += len(evicted)
+        try:
+            await self.run_io(self._write, [(key, text, now) for key in keys], evicted)
+        except Exception as e:
+            logger.error(f"Error persisting transcript cache: {str(e)}", exc_info=True)
+
+    async def single_flight(self, key, factory):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Shielded so one impatient caller can't cancel the upload everyone else is waiting on
+        return await asyncio.shield(task)
+
+    def _connect(self):
+        # Caller holds the lock
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS transcripts (key TEXT PRIMARY KEY, text TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+        return self.db
+
+    def _load(self, min_created, limit):
+        with self.db_lock:
+            db = self._connect()
+            with db:
+                db.execute("DELETE FROM transcripts WHERE created_at < ?", (min_created,))
+            rows = db.execute(
+                "SELECT key, text, created_at FROM transcripts ORDER BY created_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return list(reversed(rows))
+
+    def _write(self, rows, evicted):
+        with self.db_lock:
+            db = self._connect()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO transcripts (key, text, created_at) VALUES (?, ?, ?)", rows)
+                db.executemany("DELETE FROM transcripts WHERE key = ?", [(key,) for key in evicted])
+
+    def close(self):
+        """Blocking, call from a worker thread"""
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": f"{self.hits / lookups:.1%}" if lookups else "n/a",
+            "coalesced_uploads": self.coalesced,
+            "in_flight": len(self.inflight),
+            "evictions": self.evictions
+        }
+
+class AudioPreprocessor:
+    """Downmixes and resamples audio to 16 kHz mono with FFmpeg, and plans silence-aligned segments"""
+    SAMPLE_RATE = 16000
+    BYTES_PER_SECOND = SAMPLE_RATE * 2  # 16-bit mono PCM
+    SILENCE_PATTERN = re.compile(r"silence_(start|end): (-?[\d.]+)")
+    
+    def __init__(self, executable="ffmpeg", segment_seconds=120, chunk_above_seconds=180,
+                 silence_threshold_db=-35, silence_min_seconds=0.4, bitrate="24k", max_seconds=1200):
+        self.executable = executable
+        self.max_seconds = max_seconds  # Decoded PCM is held in memory, 16 kHz mono is ~1.9 MB per minute
+        self.segment_seconds = segment_seconds
+        self.chunk_above_seconds = chunk_above_seconds
+        self.silence_threshold_db = silence_threshold_db
+        self.silence_min_seconds = silence_min_seconds
+        self.bitrate = bitrate
+        
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.segments = 0
+        self.too_long = 0
+
+    async def decode(self, chunks):
+        """Decode an async iterable of encoded audio to 16 kHz mono PCM, returns (pcm, silences)"""
+        process = await self._spawn(
+            "-i", "pipe:0",
+            "-af", f"silencedetect=noise={self.silence_threshold_db}dB:d={self.silence_min_seconds}",
+            "-ac", "1", "-ar", str(self.SAMPLE_RATE), "-f", "s16le", "pipe:1",
+            loglevel="info"
+        )
+        
+        stopped_reading = False
+        
+        async def feed():
+            nonlocal stopped_reading
+            try:
+                async for chunk in chunks:
+                    self.bytes_in += len(chunk)
+                    try:
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+                    except ConnectionError:
+                        # FFmpeg rejected the input and exited, its log says why
+                        stopped_reading = True
+                        return
+            finally:
+                process.stdin.close()
+                
+        async def read_pcm():
+            limit = int(self.max_seconds * self.BYTES_PER_SECOND)
+            pcm = bytearray()
+            while True:
+                chunk = await process.stdout.read(64 * 1024)
+                if not chunk:
+                    return pcm
+                pcm += chunk
+                if len(pcm) > limit:
+                    self.too_long += 1
+                    raise AudioPreprocessingError(f"audio is longer than {self.max_seconds:g}s, too long to decode in memory")
+                
+        # Download, decode and read back all at once, FFmpeg starts while bytes are still arriving
+        feeder = asyncio.create_task(feed())
+        stdout = asyncio.create_task(read_pcm())
+        stderr = asyncio.create_task(process.stderr.read())
+        try:
+            # Gathered so a clip over the limit stops everything, FFmpeg would otherwise block the feeder
+            _, pcm, log = await asyncio.gather(feeder, stdout, stderr)
+            await process.wait()
+        except BaseException:
+            for task in (feeder, stdout, stderr):
+                task.cancel()
+            if process.returncode is None:
+                process.kill()
+            raise
+        if stopped_reading or process.returncode != 0 or not pcm:
+            raise AudioPreprocessingError(f"FFmpeg could not decode audio: {log.decode(errors='ignore')[-300:]}")
+        return pcm, self.parse_silences(log.decode(errors="ignore"))
+
+    async def encode(self, pcm, sample_rate=SAMPLE_RATE, channels=1):
+        """Encode s16le PCM (16 kHz mono unless told otherwise) to compact 16 kHz mono Ogg/Opus"""
+        process = await self._spawn(
+            "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0",
+            "-ac", "1", "-ar", str(self.SAMPLE_RATE),
+            "-c:a", "libopus", "-b:a", self.bitrate, "-application", "voip", "-f", "ogg", "pipe:1"
+        )
+        encoded, log = await process.communicate(pcm)
+        if process.returncode != 0 or not encoded:
+            raise AudioPreprocessingError(f"FFmpeg could not encode audio: {log.decode(errors='ignore')[-300:]}")
+        self.bytes_out += len(encoded)
+        self.segments += 1
+        return encoded
+
+    def parse_silences(self, log):
+        silences = []
+        start = None
+        for kind, value in self.SILENCE_PATTERN.findall(log):
+            if kind == "start":
+                start = max(0.0, float(value))
+            elif start is not None:
+                silences.append((start, float(value)))
+                start = None
+        return silences
+
+    def plan_segments(self, duration, silences):
+        """Split points for long audio, preferring the last silence before each segment boundary"""
+        if duration <= self.chunk_above_seconds:
+            return [(0.0, duration)]
+        midpoints = [(start + end) / 2 for start, end in silences]
+        cuts = []
+        start = 0.0
+        while duration - start > self.segment_seconds:
+            target = start + self.segment_seconds
+            candidates = [point for point in midpoints if start + self.segment_seconds / 2 <= point <= target]
+            cut = max(candidates) if candidates else target  # No usable pause, hard cut
+            cuts.append(cut)
+            start = cut
+        bounds = [0.0] + cuts + [duration]
+        return list(zip(bounds, bounds[1:]))
+
+    def slice_pcm(self, pcm, start, end):
+        # Keep offsets on sample boundaries
+        first = int(start * self.SAMPLE_RATE) * 2
+        last = int(end * self.SAMPLE_RATE) * 2
+        return pcm[first:last]
+
+    async def _spawn(self, *args, loglevel="error"):
+        try:
+            return await asyncio.create_subprocess_exec(
+                self.executable, "-hide_banner", "-loglevel", loglevel, *args,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+        except FileNotFoundError:
+            raise AudioPreprocessingError(f"{self.executable} was not found") from None
+
+    def stats(self):
+        return {
+            "bytes_received": self.bytes_in,
+            "bytes_uploaded": self.bytes_out,
+            "upload_ratio": f"{self.bytes_out / self.bytes_in:.1%}" if self.bytes_in else "n/a",
+            "segments_encoded": self.segments,
+            "too_long_to_decode": self.too_long
+        }
+
+class VoiceReceiver:
+    """Cuts per-speaker 48 kHz stereo PCM frames into utterances with an energy-based voice activity detector"""
+    SAMPLE_RATE = 48000
+    CHANNELS = 2
+    FRAME_SECONDS = 0.02
+    BYTES_PER_SECOND = SAMPLE_RATE * CHANNELS * 2
+    
+    def __init__(self, threshold_db=-45, start_ms=60, hangover_ms=500, preroll_ms=200,
+                 min_utterance_ms=300, max_utterance_seconds=20, queue_size=8, idle_forget_seconds=300):
+        self.threshold = (32768 * 10 ** (threshold_db / 20)) ** 2  # As mean square amplitude
+        self.start_frames = max(1, round(start_ms / 1000 / self.FRAME_SECONDS))
+        self.hangover = hangover_ms / 1000
+        self.preroll_frames = round(preroll_ms / 1000 / self.FRAME_SECONDS)
+        self.min_bytes = int(min_utterance_ms / 1000 * self.BYTES_PER_SECOND)
+        self.max_bytes = int(max_utterance_seconds * self.BYTES_PER_SECOND)
+        self.idle_forget_seconds = idle_forget_seconds
+        
+        self.speakers = {}
+        self.closed = deque()  # (speaker_id, pcm, ended_at), oldest dropped when full
+        self.queue_size = queue_size
+        self.ready = asyncio.Event()
+        
+        self.frames = 0
+        self.utterances = 0
+        self.too_short = 0
+        self.forced_cuts = 0
+        self.dropped = 0
+
+    def feed(self, speaker_id, pcm, now=None):
+        """Add one decoded frame, called by the audio source as packets arrive"""
+        now = time.monotonic() if now is None else now
+        self.frames += 1
+        stream = self.speakers.get(speaker_id)
+        if stream is None:
+            stream = self.speakers[speaker_id] = {
+                "preroll": deque(maxlen=self.preroll_frames + self.start_frames),
+                "frames": [], "size": 0, "voiced_size": 0, "voiced_run": 0,
+                "active": False, "last_frame_at": now, "last_voice_at": now
+            }
+        stream["last_frame_at"] = now
+        voiced = self.is_voiced(pcm)
+        
+        if not stream["active"]:
+            # Wait for a few voiced frames in a row so clicks and breaths don't open an utterance
+            stream["preroll"].append(pcm)
+            stream["voiced_run"] = stream["voiced_run"] + 1 if voiced else 0
+            if stream["voiced_run"] >= self.start_frames:
+                stream["frames"] = list(stream["preroll"])
+                stream["size"] = stream["voiced_size"] = sum(len(frame) for frame in stream["frames"])
+                stream["preroll"].clear()
+                stream["active"] = True
+                stream["last_voice_at"] = now
+            return
+            
+        stream["frames"].append(pcm)
+        stream["size"] += len(pcm)
+        if voiced:
+            stream["voiced_size"] = stream["size"]
+            stream["last_voice_at"] = now
+        if now - stream["last_voice_at"] >= self.hangover:
+            self.close(speaker_id, stream)
+        elif stream["size"] >= self.max_bytes:
+            # Nobody pauses for this long, cut here so the buffer stays bounded
+            self.forced_cuts += 1
+            self.close(speaker_id, stream)
+            stream["active"] = True
+            stream["last_voice_at"] = now
+
+    def sweep(self, now=None):
+        """Close utterances whose speaker stopped sending, Discord sends nothing at all during silence"""
+        now = time.monotonic() if now is None else now
+        for speaker_id, stream in list(self.speakers.items()):
+            if stream["active"] and now - stream["last_frame_at"] >= self.hangover:
+                self.close(speaker_id, stream)
+            elif not stream["active"] and now - stream["last_frame_at"] >= self.idle_forget_seconds:
+                del self.speakers[speaker_id]
+
+    def close(self, speaker_id, stream):
+        pcm = b"".join(stream["frames"])[:stream["voiced_size"]]  # Trailing silence is just upload cost
+        ended_at = stream["last_voice_at"]
+        stream["frames"] = []
+        stream["size"] = stream["voiced_size"] = stream["voiced_run"] = 0
+        stream["active"] = False
+        if len(pcm) < self.min_bytes:
+            self.too_short += 1
+            return
+        if len(self.closed) >= self.queue_size:
+            # Transcription is falling behind, the oldest speech is the least useful to answer now
+            self.closed.popleft()
+            self.dropped += 1
+        self.closed.append((speaker_id, pcm, ended_at))
+        self.utterances += 1
+        self.ready.set()
+
+    async def next_utterance(self):
+        while not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.closed.popleft()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.hangover / 4)
+            self.sweep()
+
+    def is_voiced(self, pcm):
+        samples = array.array("h", pcm[:len(pcm) // 2 * 2])
+        if sys.byteorder == "big":
+            samples.byteswap()
+        # Every 8th sample of the interleaved stereo frame is plenty to gauge loudness
+        samples = samples[::8]
+        if not samples:
+            return False
+        return sum(sample * sample for sample in samples) / len(samples) >= self.threshold
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "speakers": len(self.speakers),
+            "speaking": sum(1 for stream in self.speakers.values() if stream["active"]),
+            "utterances": self.utterances,
+            "queued": len(self.closed),
+            "too_short": self.too_short,
+            "forced_cuts": self.forced_cuts,
+            "dropped_backpressure": self.dropped
+        }
+
+class ListeningVoiceClient(nextcord.VoiceClient):
+    """Voice client that can also receive, nextcord only implements sending"""
+    SILENCE_FRAME = b"\xf8\xff\xfe"
+    
+    def __init__(self, client, channel):
+        super().__init__(client, channel)
+        self.ssrc_users = {}
+        self.decoders = {}
+        self.packets = 0
+        self.bad_packets = 0
+
+    async def connect_websocket(self):
+        ws = await super().connect_websocket()
+        ws._hook = self.voice_ws_hook
+        return ws
+
+    async def voice_ws_hook(self, ws, msg):
+        # SPEAKING tells us which user sends on which SSRC
+        data = msg.get("d") or {}
+        if msg.get("op") == ws.SPEAKING and "ssrc" in data:
+            self.ssrc_users[data["ssrc"]] = int(data["user_id"])
+        elif msg.get("op") == ws.CLIENT_DISCONNECT:
+            user_id = int(data["user_id"])
+            for ssrc in [ssrc for ssrc, user in self.ssrc_users.items() if user == user_id]:
+                del self.ssrc_users[ssrc]
+                self.decoders.pop(ssrc, None)
+
+    async def listen(self, feed):
+        """Read RTP packets until cancelled, passing decoded PCM per user to feed"""
+        loop = asyncio.get_running_loop()
+        while True:
+            sock = self.socket
+            if not self.is_connected() or not sock:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                # Timeout so a socket replaced by a reconnect isn't waited on forever
+                packet = await asyncio.wait_for(loop.sock_recv(sock, 4096), timeout=1.0)
+            except (asyncio.TimeoutError, OSError):
+                continue
+            self.handle_packet(packet, feed)
+
+    def handle_packet(self, packet, feed):
+        # RTCP packet types 200-204 share the socket
+        if len(packet) < 12 or 200 <= packet[1] <= 204:
+            return
+        ssrc = struct.unpack_from(">I", packet, 8)[0]
+        user_id = self.ssrc_users.get(ssrc)
+        if user_id is None:
+            return
+        self.packets += 1
+        try:
+            opus = getattr(self, "_decrypt_" + self.mode)(packet)
+            if packet[0] & 0x10:
+                # One-byte header extension, encrypted along with the payload
+                length = struct.unpack_from(">H", opus, 2)[0]
+                opus = opus[4 + 4 * length:]
+            if opus == self.SILENCE_FRAME:
+                return
+            decoder = self.decoders.get(ssrc)
+            if decoder is None:
+                decoder = self.decoders[ssrc] = nextcord.opus.Decoder()
+            pcm = decoder.decode(opus, fec=False)
+        except Exception:
+            self.bad_packets += 1
+            return
+        feed(user_id, pcm)
+
+    def _decrypt_xsalsa20_poly1305(self, packet):
+        nonce = bytearray(24)
+        nonce[:12] = packet[:12]
+        return nacl.secret.SecretBox(bytes(self.secret_key)).decrypt(bytes(packet[12:]), bytes(nonce))
+
+    def _decrypt_xsalsa20_poly1305_suffix(self, packet):
+        return nacl.secret.SecretBox(bytes(self.secret_key)).decrypt(bytes(packet[12:-24]), bytes(packet[-24:]))
+
+    def _decrypt_xsalsa20_poly1305_lite(self, packet):
+        nonce = bytearray(24)
+        nonce[:4] = packet[-4:]
+        return nacl.secret.SecretBox(bytes(self.secret_key)).decrypt(bytes(packet[12:-4]), bytes(nonce))
+
+    def stats(self):
+        return {"packets": self.packets, "bad_packets": self.bad_packets, "known_speakers": len(self.ssrc_users)}
+
 class ChatCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.groq_api_key = os.getenv("GROQ_API_KEY", "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")
-        self.chat_api_url = "https://api.groq.com/openai/v1/chat/completions"
-        self.stt_api_url = "https://api.groq.com/openai/v1/audio/transcriptions"
+        api_base = os.getenv("GROQ_API_BASE", "https://api.groq.com/openai/v1").rstrip("/")
+        self.chat_api_url = f"{api_base}/chat/completions"
+        self.stt_api_url = f"{api_base}/audio/transcriptions"
+        self.chat_timeout = float(os.getenv("GROQ_CHAT_TIMEOUT", "60"))
+        self.stt_timeout = float(os.getenv("GROQ_STT_TIMEOUT", "120"))
+        self.stt_max_bytes = int(float(os.getenv("STT_MAX_MB", "25")) * 1024 * 1024)
+        # Clips up to this size are hashed before upload so reposts are recognized, bigger ones stream through
+        self.stt_dedup_max_bytes = int(float(os.getenv("STT_DEDUP_MAX_MB", "4")) * 1024 * 1024)
+        
+        # Audio is downmixed to 16 kHz mono before upload, long clips are transcribed in parallel segments
+        self.ffmpeg_path = os.getenv("FFMPEG_PATH", "ffmpeg")  # Also used for voice playback
+        self.audio_preprocessor = None
+        if os.getenv("STT_NORMALIZE", "1") == "1" and shutil.which(self.ffmpeg_path):
+            self.audio_preprocessor = AudioPreprocessor(
+                executable=self.ffmpeg_path,
+                segment_seconds=float(os.getenv("STT_SEGMENT_SECONDS", "120")),
+                chunk_above_seconds=float(os.getenv("STT_CHUNK_ABOVE_SECONDS", "180")),
+                bitrate=os.getenv("STT_BITRATE", "24k"),
+                max_seconds=float(os.getenv("STT_MAX_DECODE_SECONDS", "1200"))
+            )
+        self.stt_segment_concurrency = int(os.getenv("STT_SEGMENT_CONCURRENCY", "4"))
+        self.stt_attachment_concurrency = int(os.getenv("STT_ATTACHMENT_CONCURRENCY", "3"))  # Files per message transcribed at once
+        self.stream_responses = os.getenv("CHAT_STREAMING", "1") == "1"
+        self.completion_token_reserve = int(os.getenv("GROQ_COMPLETION_RESERVE", "400"))  # Expected reply size for TPM budgeting
+        self.stream_edit_interval = float(os.getenv("CHAT_STREAM_EDIT_INTERVAL", "1.0"))
+        
+        # One pooled session for every Groq call instead of a new one per message,
+        # admitted through a shared rate limit / priority scheduler
+        self.http = GroqHTTPClient(
+            self.groq_api_key,
+            scheduler=RequestScheduler(
+                requests_per_minute=int(os.getenv("GROQ_RPM", "300")),
+                tokens_per_minute=int(os.getenv("GROQ_TPM", "100000")),
+                max_concurrency=int(os.getenv("GROQ_MAX_CONCURRENCY", "32"))
+            ),
+            max_attempts=int(os.getenv("GROQ_MAX_ATTEMPTS", "4")),
+            pool_size=int(os.getenv("GROQ_POOL_SIZE", "100")),
+            pool_size_per_host=int(os.getenv("GROQ_POOL_SIZE_PER_HOST", "0")),
+            keepalive_timeout=float(os.getenv("GROQ_KEEPALIVE_TIMEOUT", "30")),
+            dns_cache_ttl=int(os.getenv("GROQ_DNS_CACHE_TTL", "300")),
+            connect_timeout=float(os.getenv("GROQ_CONNECT_TIMEOUT", "10"))
+        )
         
         # Available models - can be changed with commands
         self.available_models = {
@@ -35,14 +2667,123 @@ class ChatCog(commands.Cog):
         }
         
         self.chat_model = self.available_models["llama"]
+        # The chosen model is preferred, the fallbacks take over when it is slow or failing
+        self.router = ModelRouter(
+            self.http, self.chat_api_url, timeout=self.chat_timeout,
+            fallbacks=[model.strip() for model in os.getenv("CHAT_FALLBACK_MODELS", "llama-3.1-8b-instant").split(",") if model.strip()],
+            policy=os.getenv("ROUTER_POLICY", "preferred"),  # Or "fastest"
+            hedge=os.getenv("ROUTER_HEDGE", "1") == "1",
+            hedge_after=float(os.getenv("ROUTER_HEDGE_AFTER", "0")),  # Seconds without output, 0 = primary's recent p95
+            max_hedge_ratio=float(os.getenv("ROUTER_MAX_HEDGE_RATIO", "0.2"))
+        )
         self.stt_model = "whisper-large-v3"
         self.temperature = 0.7
         self.voice_clients = {}
-        self.conversation_history = {}  # Store conversation history per channel
+        self.playback = {}  # Per-guild playback schedulers
+        self.voice_barge_in = os.getenv("VOICE_BARGE_IN", "0") == "1"  # New replies cut off the one playing
+        
+        # Listening in voice channels: speech is cut into utterances as it arrives and each is transcribed right away
+        self.voice_receive = os.getenv("VOICE_RECEIVE", "1") == "1" and nacl is not None
+        self.voice_vad_threshold_db = float(os.getenv("VOICE_VAD_THRESHOLD_DB", "-45"))
+        self.voice_vad_hangover_ms = int(os.getenv("VOICE_VAD_HANGOVER_MS", "500"))  # Pause that ends an utterance
+        self.voice_max_utterance_seconds = float(os.getenv("VOICE_MAX_UTTERANCE_SECONDS", "20"))
+        self.voice_queue_size = int(os.getenv("VOICE_QUEUE_SIZE", "8"))  # Closed utterances waiting per guild
+        self.voice_stale_seconds = float(os.getenv("VOICE_STALE_SECONDS", "15"))  # Older speech isn't worth answering
+        self.voice_stt_concurrency = int(os.getenv("VOICE_STT_CONCURRENCY", "2"))
+        self.listeners = {}  # guild_id -> (receiver, source, tasks)
+        self.voice_stats = {"transcribed": 0, "empty": 0, "stale_dropped": 0, "failed": 0, "shed": 0}
+        self.context_max_tokens = int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+        self.summary_model = os.getenv("SUMMARY_MODEL", "llama-3.1-8b-instant")
         self.speaking_speed = 1.0  # Normal speed by default
-        self.typing_indicators = {}  # Track typing indicators
-        self.user_preferences = self.load_preferences()
-        self.last_activity = {}  # Track last activity time per channel
+        self.voice_max_chars = int(os.getenv("VOICE_MAX_CHARS", "3000"))  # Upper bound on spoken reply length
+        self.tts_prefetch = int(os.getenv("TTS_PREFETCH", "2"))  # Sentences synthesized ahead of playback
+        self.typing = TypingManager()  # Shared per-channel typing indicators
+        self.inboxes = {}  # Per-channel message coalescing
+        self.coalesce_window = float(os.getenv("COALESCE_WINDOW", "0.4"))  # Seconds to wait for follow-up messages
+        self.coalesce_max_wait = float(os.getenv("COALESCE_MAX_WAIT", "3"))
+        self.coalesce_stats = {"messages": 0, "turns": 0, "superseded": 0}
+        # Incoming work shares a fixed pool of slots, and floods get shed instead of queueing forever
+        self.inbound = InboundScheduler(
+            workers=int(os.getenv("INBOUND_WORKERS", "8")),
+            max_per_user=int(os.getenv("INBOUND_MAX_PER_USER", "6")),
+            max_per_guild=int(os.getenv("INBOUND_MAX_PER_GUILD", "30")),
+            max_outstanding=int(os.getenv("INBOUND_MAX_QUEUE", "200")),
+            defer_notice_depth=int(os.getenv("INBOUND_DEFER_NOTICE_DEPTH", "8")),  # Queued jobs before ⏳ reactions
+            notice_cooldown=float(os.getenv("INBOUND_NOTICE_COOLDOWN", "30"))
+        )
+        # Thinking messages, reactions and the thinking pause are cosmetic, they give way under rate-limit pressure
+        self.rest_budget = RestBudget(
+            reserve=int(os.getenv("REST_COSMETIC_RESERVE", "2")),  # Calls per route kept for replies
+            fast_path_rate=float(os.getenv("REST_FAST_PATH_RATE", "30")),  # Guild messages per minute, 0 = off
+            fast_path_guilds=[int(guild) for guild in os.getenv("REST_FAST_PATH_GUILDS", "").split(",") if guild.strip()]
+        )
+        # Blocking work (gTTS, preferences, history) runs here instead of on the event loop
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("IO_WORKERS", "8")),
+            thread_name_prefix="chatbot-io"
+        )
+        self.io_in_flight = 0
+        self.tts_per_guild = int(os.getenv("TTS_PER_GUILD", "1"))  # Concurrent syntheses per guild
+        self.tts_guild_limits = {}
+        self.tts_language = os.getenv("TTS_LANGUAGE", "en")
+        self.tts_cache = TTSCache(
+            os.getenv("TTS_CACHE_DIR", "tts_cache"),
+            memory_limit=int(float(os.getenv("TTS_CACHE_MEMORY_MB", "32")) * 1024 * 1024),
+            disk_limit=int(float(os.getenv("TTS_CACHE_DISK_MB", "512")) * 1024 * 1024)
+        )
+        # Transcriptions of clips we've already heard
+        self.transcripts = TranscriptCache(
+            os.getenv("STT_CACHE_DB", "transcripts.db"),
+            self.run_io,
+            max_entries=int(os.getenv("STT_CACHE_MAX_ENTRIES", "5000")),
+            ttl=float(os.getenv("STT_CACHE_TTL_HOURS", "168")) * 3600
+        )
+        
+        # State every bot process has to agree on: "local" for a single process, "redis" to run several
+        # processes or shards against one Redis-compatible server. Voice connections always stay per process.
+        if os.getenv("STATE_BACKEND", "local") == "redis":
+            self.state = RedisStateBackend(
+                os.getenv("STATE_REDIS_URL", "redis://127.0.0.1:6379/0"),
+                prefix=os.getenv("STATE_KEY_PREFIX", "chatbot:")
+            )
+        else:
+            self.state = LocalStateBackend()
+        self.state_sync_interval = float(os.getenv("STATE_SYNC_INTERVAL", "2"))  # Settings and idle activity
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32):08x}"  # Lease owner
+        self.pending_activity = {}  # channel id -> last activity not yet published
+        # Settings changes made here vs. taken by the backend, an unsaved change is retried before the next load
+        self.settings_version = 0
+        self.settings_saved_version = 0
+        shared_state = self.state if self.state.shared else None
+        
+        # User preferences, loaded lazily and written behind
+        self.preferences = PreferencesStore(
+            os.getenv("PREFERENCES_FILE", "user_preferences.json"),
+            self.run_io,
+            flush_delay=float(os.getenv("PREFERENCES_FLUSH_DELAY", "2")),
+            backend=shared_state
+        )
+        
+        # Conversation history per channel, bounded in memory and spilled to disk
+        self.history = HistoryStore(
+            os.getenv("HISTORY_DB", "chat_history.db"),
+            self.run_io,
+            self.new_context,
+            max_active=int(os.getenv("HISTORY_MAX_ACTIVE", "1000")),
+            flush_interval=float(os.getenv("HISTORY_FLUSH_INTERVAL", "5")),
+            backend=shared_state
+        )
+        self.loop_monitor = LoopLagMonitor(
+            interval=float(os.getenv("LOOP_LAG_INTERVAL", "0.5")),
+            warn_threshold=float(os.getenv("LOOP_LAG_WARN", "0.25"))
+        )
+        # Idle channels get a nudge IDLE_NUDGE_AFTER seconds after their last activity
+        self.idle_scheduler = IdleScheduler(
+            idle_after=float(os.getenv("IDLE_NUDGE_AFTER", "600")),
+            expire_after=float(os.getenv("IDLE_EXPIRE_AFTER", "1800"))
+        )
+        self.idle_nudge_chance = float(os.getenv("IDLE_NUDGE_CHANCE", "0.35"))  # About the odds of the old 10%-per-scan check
+        self.idle_nudge_limit = asyncio.Semaphore(int(os.getenv("IDLE_NUDGE_CONCURRENCY", "10")))
         self.idle_messages = [
             "I'm still here if you want to chat!",
             "Been quiet for a bit. How are you doing?",
@@ -52,8 +2793,33 @@ class ChatCog(commands.Cog):
             "Feel like chatting about something interesting?"
         ]
         
+        # Prometheus text endpoint, local only by default, 0 turns it off
+        self.metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+        self.metrics_port = int(os.getenv("METRICS_PORT", "0"))
+        metrics.collect("tts_cache", self.tts_cache.stats)
+        metrics.collect("transcripts", self.transcripts.stats)
+        metrics.collect("history", self.history.stats)
+        metrics.collect("groq_pool", self.http.stats)
+        metrics.collect("groq_scheduler", self.http.scheduler.stats)
+        metrics.collect("router", self.router.stats)
+        metrics.collect("typing", self.typing.stats)
+        metrics.collect("event_loop", self.loop_monitor.stats)
+        metrics.collect("idle", self.idle_scheduler.stats)
+        metrics.collect("coalesce", lambda: self.coalesce_stats)
+        metrics.collect("inbound", self.inbound.stats)
+        metrics.collect("rest_budget", self.rest_budget.stats)
+        metrics.collect("state", self.state.stats)
+        metrics.collect("voice", lambda: self.voice_stats)
+        metrics.collect("runtime", self.runtime_gauges)
+        if self.audio_preprocessor is not None:
+            metrics.collect("stt_preprocessor", self.audio_preprocessor.stats)
+        
         # Start background tasks
         self.check_idle_channels_task = self.bot.loop.create_task(self.check_idle_channels())
+        self.loop_monitor_task = self.bot.loop.create_task(self.loop_monitor.run())
+        self.history_flush_task = self.bot.loop.create_task(self.history.run())
+        self.metrics_server_task = self.bot.loop.create_task(self.serve_metrics()) if self.metrics_port else None
+        self.state_sync_task = self.bot.loop.create_task(self.sync_state()) if self.state.shared else None
         
         # Personality traits that make the bot feel more human
         self.personality = {
@@ -77,20 +2843,91 @@ class ChatCog(commands.Cog):
             ]
         }
         
-    def load_preferences(self):
+        # Canned phrases are a small fixed set, synthesize them once up front
+        self.bot.loop.create_task(self.prewarm_tts_cache())
+        
+    def cog_unload(self):
+        self.check_idle_channels_task.cancel()
+        for playback in self.playback.values():
+            playback.close()
+        for guild_id in list(self.listeners):
+            self.stop_listening(guild_id)
+        self.typing.close()
+        self.loop_monitor_task.cancel()
+        self.history_flush_task.cancel()
+        if self.metrics_server_task:
+            self.metrics_server_task.cancel()
+        if self.state_sync_task:
+            self.state_sync_task.cancel()
+        metrics.collectors.clear()
+        self.bot.loop.create_task(self.shutdown())
+        
+    async def shutdown(self):
+        # Final write-behind flush needs the I/O pool, so it goes down last
         try:
-            with open('user_preferences.json', 'r') as file:
-                return json.load(file)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+            await self.history.close()
+        except Exception as e:
+            logger.error(f"Error closing conversation history: {str(e)}", exc_info=True)
+        await self.preferences.close()
+        try:
+            await self.publish_activity()
+        except StateBackendError as e:
+            logger.error(f"Error publishing idle activity: {str(e)}")
+        await self.state.close()
+        await self.run_io(self.transcripts.close)
+        await self.http.close()
+        self.io_executor.shutdown(wait=False)
+        
+    async def serve_metrics(self):
+        async def handle(request):
+            return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
             
-    def save_preferences(self):
-        with open('user_preferences.json', 'w') as file:
-            json.dump(self.user_preferences, file)
-    
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.metrics_host, self.metrics_port).start()
+            logger.info(f"Serving metrics on http://{self.metrics_host}:{self.metrics_port}/metrics")
+            await asyncio.Event().wait()
+        except OSError as e:
+            logger.error(f"Could not serve metrics on port {self.metrics_port}: {str(e)}")
+        finally:
+            await runner.cleanup()
+
+    def runtime_gauges(self):
+        return {
+            "io_in_flight": self.io_in_flight,
+            "playback_queue_depth": sum(playback.queue_depth() for playback in self.playback.values()),
+            "inbox_pending": sum(len(inbox.pending) for inbox in self.inboxes.values()),
+            "generations_in_flight": sum(1 for inbox in self.inboxes.values() if inbox.generation is not None),
+            "voice_utterances_queued": sum(len(receiver.closed) for receiver, _, _ in self.listeners.values())
+        }
+
+    def new_context(self, record=None):
+        if record is None:
+            return ConversationContext(max_tokens=self.context_max_tokens)
+        return ConversationContext.from_record(record, max_tokens=self.context_max_tokens)
+        
+    async def run_io(self, func, *args, **kwargs):
+        """Run a blocking call in the bounded I/O pool"""
+        self.io_in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.io_executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self.io_in_flight -= 1
+            
+    def tts_guild_limit(self, guild_id):
+        if guild_id not in self.tts_guild_limits:
+            self.tts_guild_limits[guild_id] = asyncio.Semaphore(self.tts_per_guild)
+        return self.tts_guild_limits[guild_id]
+        
     @commands.Cog.listener()
     async def on_ready(self):
         logger.info(f"ChatBot is ready and logged in as {self.bot.user}")
+        await self.http.start()
         await self.bot.change_presence(activity=nextcord.Activity(
             type=nextcord.ActivityType.listening, 
             name="your voice | !help"
@@ -101,12 +2938,17 @@ class ChatCog(commands.Cog):
         if ctx.author.voice and ctx.author.voice.channel:
             channel = ctx.author.voice.channel
             if ctx.guild.id not in self.voice_clients:
-                vc = await channel.connect()
+                vc = await channel.connect(cls=ListeningVoiceClient if self.voice_receive else nextcord.VoiceClient)
                 self.voice_clients[ctx.guild.id] = vc
+                self.playback[ctx.guild.id] = GuildPlayback(vc, executable=self.ffmpeg_path)
+                if self.voice_receive:
+                    self.start_listening(ctx.guild, vc, ctx.channel)
                 
                 embed = Embed(
                     title="🔊 Voice Connected",
-                    description=f"Joined {channel.name}! Now listening for voice messages.",
+                    description=f"Joined {channel.name}! " + (
+                    "Now listening, just talk to me." if self.voice_receive else "Now listening for voice messages."
+                ),
                     color=Color.green()
                 )
                 embed.set_footer(text="Send audio files or mention me to chat!")
@@ -114,7 +2956,7 @@ class ChatCog(commands.Cog):
                 
                 # Greet the user
                 greeting = random.choice(self.personality["greeting_phrases"])
-                await self.play_voice_message(ctx.guild.id, greeting)
+                self.play_voice_message(ctx.guild.id, greeting, priority=GuildPlayback.PRIORITY_SYSTEM)
                 await ctx.send(greeting)
             else:
                 await ctx.send("🔊 **Already in a voice channel!** Use `!move` to change channels.")
@@ -124,17 +2966,24 @@ class ChatCog(commands.Cog):
     @commands.command(name="leave")
     async def leave_voice(self, ctx):
         if ctx.guild.id in self.voice_clients:
-            vc = self.voice_clients.pop(ctx.guild.id)
-            
             # Say goodbye before disconnecting
             farewell = random.choice(self.personality["farewell_phrases"])
             await ctx.send(farewell)
-            await self.play_voice_message(ctx.guild.id, farewell)
+            # The goodbye cuts off whatever is playing and drops queued replies, like before
+            farewell_done = self.play_voice_message(
+                ctx.guild.id, farewell, priority=GuildPlayback.PRIORITY_SYSTEM, barge_in=True
+            )
             
-            # Wait for voice to finish before disconnecting
-            while vc.is_playing():
-                await asyncio.sleep(0.5)
+            self.stop_listening(ctx.guild.id)
+            
+            # Nothing new can be queued once the scheduler is gone, wait for the farewell only
+            playback = self.playback.pop(ctx.guild.id, None)
+            if playback:
+                if farewell_done is not None:
+                    await farewell_done
+                playback.close()
                 
+            vc = self.voice_clients.pop(ctx.guild.id)
             await vc.disconnect()
             
             embed = Embed(
@@ -150,9 +2999,14 @@ class ChatCog(commands.Cog):
     async def change_model(self, ctx, model_name=None):
         if model_name is None:
             models_list = "\n".join([f"• **{name}**: {model}" for name, model in self.available_models.items()])
+            router_stats = self.router.stats()
+            health = "\n".join(f"• {model}: {router_stats[model]}" for model in self.router.models)
             embed = Embed(
                 title="🤖 Available AI Models",
-                description=f"Current model: **{self.chat_model}**\n\n{models_list}\n\nUse `!model [name]` to switch.",
+                description=(
+                    f"Current model: **{self.chat_model}**\n\n{models_list}\n\nUse `!model [name]` to switch."
+                    + (f"\n\n**Routing**\n{health}" if health else "")
+                ),
                 color=Color.blue()
             )
             await ctx.send(embed=embed)
@@ -160,7 +3014,8 @@ class ChatCog(commands.Cog):
             
         if model_name.lower() in self.available_models:
             self.chat_model = self.available_models[model_name.lower()]
-            await ctx.send(f"🔄 Model changed to **{self.chat_model}**")
+            saved = await self.save_settings()
+            await ctx.send(f"🔄 Model changed to **{self.chat_model}**" + self.unsaved_note(saved))
         else:
             await ctx.send(f"❌ Model not found. Available models: {', '.join(self.available_models.keys())}")
 
@@ -174,13 +3029,11 @@ class ChatCog(commands.Cog):
             temp = float(temp)
             if 0.1 <= temp <= 1.5:
                 self.temperature = temp
-                await ctx.send(f"🌡️ Temperature set to **{self.temperature}**")
+                saved = await self.save_settings()
+                await ctx.send(f"🌡️ Temperature set to **{self.temperature}**" + self.unsaved_note(saved))
                 
                 # Save user preference
-                if str(ctx.author.id) not in self.user_preferences:
-                    self.user_preferences[str(ctx.author.id)] = {}
-                self.user_preferences[str(ctx.author.id)]["temperature"] = temp
-                self.save_preferences()
+                await self.preferences.set(str(ctx.author.id), "temperature", temp)
             else:
                 await ctx.send("❌ Temperature must be between 0.1 and 1.5")
         except ValueError:
@@ -196,13 +3049,11 @@ class ChatCog(commands.Cog):
             speed = float(speed)
             if 0.5 <= speed <= 2.0:
                 self.speaking_speed = speed
-                await ctx.send(f"🔊 Speaking speed set to **{self.speaking_speed}x**")
+                saved = await self.save_settings()
+                await ctx.send(f"🔊 Speaking speed set to **{self.speaking_speed}x**" + self.unsaved_note(saved))
                 
                 # Save user preference
-                if str(ctx.author.id) not in self.user_preferences:
-                    self.user_preferences[str(ctx.author.id)] = {}
-                self.user_preferences[str(ctx.author.id)]["speaking_speed"] = speed
-                self.save_preferences()
+                await self.preferences.set(str(ctx.author.id), "speaking_speed", speed)
             else:
                 await ctx.send("❌ Speed must be between 0.5 and 2.0")
         except ValueError:
@@ -211,40 +3062,116 @@ class ChatCog(commands.Cog):
     @commands.command(name="clear")
     async def clear_history(self, ctx):
         channel_id = str(ctx.channel.id)
-        if channel_id in self.conversation_history:
-            self.conversation_history[channel_id] = []
+        context = await self.history.get(channel_id, create=False)
+        if context is not None:
+            context.clear()
+            self.history.mark_dirty(channel_id, context)
             await ctx.send("🧹 Conversation history cleared! Let's start fresh.")
         else:
             await ctx.send("📝 No conversation history to clear.")
 
+    def stats_embed(self, title, stats):
+        return Embed(
+            title=title,
+            description="\n".join([f"• **{name}**: {value}" for name, value in stats.items()]),
+            color=Color.blue()
+        )
+
+    @commands.command(name="sttstats")
+    @commands.is_owner()
+    async def stt_stats(self, ctx):
+        stats = self.transcripts.stats()
+        if self.audio_preprocessor is not None:
+            stats.update(self.audio_preprocessor.stats())
+        await ctx.send(embed=self.stats_embed("🎤 Speech to Text", stats))
+
+    @commands.command(name="historystats")
+    @commands.is_owner()
+    async def history_stats(self, ctx):
+        await ctx.send(embed=self.stats_embed("🗂️ Conversation History", self.history.stats()))
+
+    @commands.command(name="ttsstats")
+    @commands.is_owner()
+    async def tts_stats(self, ctx):
+        await ctx.send(embed=self.stats_embed("🗣️ TTS Cache", self.tts_cache.stats()))
+
+    @commands.command(name="loopstats")
+    @commands.is_owner()
+    async def loop_stats(self, ctx):
+        stats = self.loop_monitor.stats()
+        stats["io_workers"] = self.io_executor._max_workers
+        stats["io_in_flight"] = self.io_in_flight
+        await ctx.send(embed=self.stats_embed("⏱️ Event Loop Health", stats))
+
+    @commands.command(name="voicestats")
+    @commands.is_owner()
+    async def voice_stats_command(self, ctx):
+        stats = dict(self.voice_stats)
+        latency = metrics.summary().get("voice_speech_to_text")
+        if latency:
+            stats["speech_to_text"] = latency
+        stats["listening_guilds"] = len(self.listeners)
+        listener = self.listeners.get(ctx.guild.id) if ctx.guild else None
+        if listener:
+            receiver, source, _ = listener
+            stats.update(receiver.stats())
+            stats.update(source.stats())
+        await ctx.send(embed=self.stats_embed("🎙️ Voice Listening", stats))
+
+    @commands.command(name="reststats")
+    @commands.is_owner()
+    async def rest_stats(self, ctx):
+        stats = self.rest_budget.stats()
+        if ctx.guild:
+            stats["this_guild_fast_path"] = self.rest_budget.fast_path(ctx.guild.id)
+        await ctx.send(embed=self.stats_embed("📡 Discord REST Budget", stats))
+
+    @commands.command(name="statestats")
+    @commands.is_owner()
+    async def state_stats(self, ctx):
+        stats = self.state.stats()
+        stats["instance"] = self.instance_id
+        stats["unpublished_activity"] = len(self.pending_activity)
+        stats["unsaved_settings"] = self.settings_saved_version < self.settings_version
+        await ctx.send(embed=self.stats_embed("🗄️ Shared State", stats))
+
+    @commands.command(name="queuestats")
+    @commands.is_owner()
+    async def queue_stats(self, ctx):
+        stats = self.inbound.stats()
+        wait = metrics.summary().get("inbound_queue_wait")
+        if wait:
+            stats["queue_wait"] = wait
+        await ctx.send(embed=self.stats_embed("📥 Inbound Queue", stats))
+
+    @commands.command(name="latency")
+    @commands.is_owner()
+    async def latency_stats(self, ctx):
+        stats = metrics.summary() or {"stages": "nothing measured yet"}
+        stats.update({f"gauge.{key}": value for key, value in self.runtime_gauges().items()})
+        await ctx.send(embed=self.stats_embed("⏱️ Where Time Goes", stats))
+
+    @commands.command(name="poolstats")
+    @commands.is_owner()
+    async def pool_stats(self, ctx):
+        stats = {**self.http.stats(), **self.http.scheduler.stats()}
+        await ctx.send(embed=self.stats_embed("🌐 Groq Connection Pool", stats))
+
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author.bot:
             return
 
         channel_id = str(message.channel.id)
-        self.last_activity[channel_id] = time.time()
-        
-        # Initialize conversation history for this channel if it doesn't exist
-        if channel_id not in self.conversation_history:
-            self.conversation_history[channel_id] = []
+        self.idle_scheduler.touch(channel_id)
+        if self.state.shared:
+            self.pending_activity[channel_id] = self.idle_scheduler.last_activity[channel_id]
+        if message.guild:
+            self.rest_budget.note_message(message.guild.id)
 
         # Process audio attachments
         if message.attachments:
-            for attachment in message.attachments:
-                if attachment.filename.endswith((".mp3", ".wav", ".m4a", ".ogg")):
-                    # Show typing indicator
-                    async with message.channel.typing():
-                        await message.add_reaction("🎧")  # Listening reaction
-                        transcription = await self.transcribe_audio(attachment)
-                        
-                        if transcription:
-                            await message.add_reaction("✅")  # Success reaction
-                            await message.channel.send(f"🎤 **{message.author.display_name} said:** {transcription}")
-                            await self.chat_response(message, transcription)
-                        else:
-                            await message.add_reaction("❌")  # Failed reaction
-                            await message.channel.send("❌ Sorry, I couldn't transcribe that audio file.")
+            await self.handle_audio_attachments(message)
 
         # Process direct mentions or messages in DMs
         is_mentioned = self.bot.user.mentioned_in(message) and not message.mention_everyone
@@ -260,192 +3187,878 @@ class ChatCog(commands.Cog):
                 await message.channel.send(greeting)
                 return
                 
-            # Process the actual message
-            await self.chat_response(message, content)
+            if not await self.admit_message(message):
+                return
+            # Process the actual message, rapid follow-ups get merged into the same turn
+            self.submit_turn(message, content)
 
-    async def chat_response(self, message, user_input):
-        channel_id = str(message.channel.id)
-        
-        # Add user message to history
-        self.conversation_history[channel_id].append({"role": "user", "content": user_input})
+    async def admit_message(self, message):
+        reason = self.inbound.admit(message)
+        if reason is None:
+            return True
+        logger.info(f"Shed message from {message.author} ({reason} limit)")
+        if self.inbound.should_notify(message.channel.id):
+            if reason == "user":
+                notice = "⏳ You're sending messages faster than I can answer, give me a moment to catch up!"
+            else:
+                notice = "⏳ I'm swamped right now and had to skip that one, try again in a bit!"
+            try:
+                await message.channel.send(notice)
+            except nextcord.HTTPException:
+                pass
+        return False
+
+    @contextlib.asynccontextmanager
+    async def inbound_slot(self, message):
+        if self.inbound.congested() and hasattr(message, "add_reaction"):
+            # Let people know they're in line rather than ignored
+            self.inbound.deferred += 1
+            await self.react(message, "⏳")
+        async with self.inbound.slot(message):
+            yield
+
+    async def react(self, message, emoji):
+        """Cosmetic reaction, skipped when the route has no headroom or the guild is on the fast path"""
+        if not self.rest_budget.allow("reaction", message.channel.id, message.guild.id if message.guild else None):
+            return
+        try:
+            await message.add_reaction(emoji)
+        except nextcord.HTTPException as e:
+            logger.warning(f"Could not add reaction {emoji}: {str(e)}")
+
+    @commands.Cog.listener()
+    async def on_http_ratelimit(self, limit, remaining, reset_after, bucket, scope):
+        self.rest_budget.exhausted(reset_after)
+
+    @commands.Cog.listener()
+    async def on_global_http_ratelimit(self, retry_after):
+        self.rest_budget.pressure(retry_after)
+
+    async def handle_audio_attachments(self, message):
+        attachments = []
+        for attachment in message.attachments:
+            if attachment.filename.lower().endswith(AUDIO_EXTENSIONS):
+                # Reject oversized or non-audio files before downloading anything
+                rejection = self.audio_rejection_reason(attachment)
+                if rejection:
+                    await message.channel.send(f"❌ {rejection}")
+                else:
+                    attachments.append(attachment)
+        if not attachments or not await self.admit_message(message):
+            return
+            
+        priority = self.request_priority(message.guild)
+        limit = asyncio.Semaphore(self.stt_attachment_concurrency)
         
-        # Keep history to reasonable size
-        if len(self.conversation_history[channel_id]) > 20:
-            self.conversation_history[channel_id] = self.conversation_history[channel_id][-20:]
+        async def transcribe(attachment):
+            async with limit:
+                try:
+                    return await self.transcribe_audio(attachment, priority)
+                except Exception as e:
+                    logger.error(f"Error transcribing {attachment.filename}: {str(e)}")
+                    return None
+                    
+        submitted = False
+        try:
+            async with self.inbound_slot(message):
+                # Show typing indicator
+                with self.typing.hold(message.channel):
+                    await self.react(message, "🎧")  # Listening reaction
+                    # All files at once, results come back in attachment order
+                    transcriptions = await asyncio.gather(*(transcribe(attachment) for attachment in attachments))
+            
+                    texts = [text for text in transcriptions if text]
+                    if texts:
+                        await self.react(message, "✅")  # Success reaction
+                    if len(texts) < len(transcriptions):
+                        await self.react(message, "❌")  # Failed reaction
+                    self.rest_budget.spend("send", message.channel.id)
+                
+                    if len(transcriptions) == 1:
+                        if texts:
+                            await message.channel.send(f"🎤 **{message.author.display_name} said:** {texts[0]}")
+                        else:
+                            await message.channel.send("❌ Sorry, I couldn't transcribe that audio file.")
+                    else:
+                        lines = [f"🎤 **{message.author.display_name} said:**"]
+                        for attachment, text in zip(attachments, transcriptions):
+                            lines.append(f"**{attachment.filename}:** {text if text else '❌ *could not transcribe*'}")
+                        for chunk in split_message("\n".join(lines)):
+                            await message.channel.send(chunk)
+                    
+            if texts:
+                # One chat turn for the whole message instead of one per file
+                self.submit_turn(message, "\n\n".join(texts))
+                submitted = True
+        finally:
+            if not submitted:
+                # Nothing to answer, the message is done
+                self.inbound.release(message)
+
+    def submit_turn(self, message, text):
+        channel_id = str(message.channel.id)
+        inbox = self.inboxes.get(channel_id)
+        if inbox is None:
+            inbox = self.inboxes[channel_id] = ChannelInbox()
+        inbox.pending.append((message, text))
+        inbox.arrived.set()
+        self.coalesce_stats["messages"] += 1
         
-        # Start typing indicator
-        typing_task = asyncio.create_task(self.show_typing_indicator(message.channel))
-        self.typing_indicators[channel_id] = typing_task
+        if inbox.superseded_by_new_message():
+            # Nothing has been shown yet, start over with the new message folded in
+            inbox.generation.cancel()
+            self.coalesce_stats["superseded"] += 1
+        if inbox.worker is None or inbox.worker.done():
+            inbox.worker = asyncio.create_task(self.run_inbox(channel_id, inbox))
+
+    async def run_inbox(self, channel_id, inbox):
+        # One worker per channel, so turns are generated and added to history strictly in order
+        batch = []
+        try:
+            while inbox.pending:
+                # Debounce: keep collecting while messages keep coming, up to the max wait
+                deadline = time.monotonic() + self.coalesce_max_wait
+                while True:
+                    inbox.arrived.clear()
+                    remaining = min(self.coalesce_window, deadline - time.monotonic())
+                    if remaining <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(inbox.arrived.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+                        
+                # Whoever has waited longest in this channel queues for a work slot,
+                # anything arriving in the meantime still joins the turn
+                async with self.inbound_slot(inbox.pending[0][0]):
+                    batch, inbox.pending = inbox.pending, []
+                    inbox.replying = False
+                    inbox.generation = asyncio.create_task(
+                        self.chat_response(batch[-1][0], self.merge_turn_text(batch), inbox)
+                    )
+                    self.coalesce_stats["turns"] += 1
+                    await asyncio.wait([inbox.generation])
+                if inbox.generation.cancelled():
+                    # Superseded, its messages go first in the next turn
+                    inbox.pending = batch + inbox.pending
+                else:
+                    for message, _ in batch:
+                        self.inbound.release(message)
+                batch = []
+                inbox.generation = None
+        except Exception as e:
+            logger.error(f"Error in run_inbox: {str(e)}", exc_info=True)
+            for message, _ in batch:
+                self.inbound.release(message)
+        finally:
+            if self.inboxes.get(channel_id) is inbox and not inbox.pending:
+                del self.inboxes[channel_id]
+
+    def merge_turn_text(self, batch):
+        if len(batch) == 1:
+            return batch[0][1]
+        if len({message.author.id for message, _ in batch}) == 1:
+            return "\n".join(text for _, text in batch)
+        # Several people talking at once, keep track of who said what
+        return "\n".join(f"{message.author.display_name}: {text}" for message, text in batch)
+
+    async def chat_response(self, message, user_input, inbox=None):
+        channel_id = str(message.channel.id)
         
-        # Select a "thinking" phrase for more human-like interaction
-        thinking_phrase = random.choice(self.personality["thinking_phrases"])
-        thinking_msg = await message.channel.send(thinking_phrase)
+        # The user turn is only added to history together with the reply, so a superseded
+        # generation leaves no trace and turns always land in order
+        # Held until the turn is over so the channel can't be evicted and reloaded under us
+        context = await self.history.acquire(channel_id)
+        user_turn = {"role": "user", "content": user_input}
+        pending_user_turn = True
         
-        # Small delay to simulate thinking
-        await asyncio.sleep(min(len(user_input) / 50, 2))
+        # Start typing indicator, shared with anything else already working in this channel
+        self.typing.acquire(message.channel)
+        thinking_msg = None
+        turn_started = time.perf_counter()
         
         try:
-            async with aiohttp.ClientSession() as session:
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.groq_api_key}"
-                }
+            # Select a "thinking" phrase for more human-like interaction, unless the channel can't spare the calls
+            guild_id = message.guild.id if message.guild else None
+            if self.rest_budget.allow("send", message.channel.id, guild_id):
+                thinking_phrase = random.choice(self.personality["thinking_phrases"])
+                with metrics.timer("discord_send"):
+                    thinking_msg = await message.channel.send(thinking_phrase)
+            
+            # Small delay to simulate thinking (skipped when streaming, first-token latency matters there),
+            # it goes together with the thinking message
+            if not self.stream_responses and thinking_msg is not None:
+                with metrics.timer("thinking_delay"):
+                    await asyncio.sleep(min(len(user_input) / 50, 2))
                 
-                # System message to make responses more conversational
-                system_message = {
-                    "role": "system", 
-                    "content": (
-                        "You are a friendly and conversational AI chatbot in a Discord server. "
-                        "You're talking with a real person who might be feeling lonely. "
-                        "Be warm, empathetic, and engage naturally like a friend would. "
-                        "Ask follow-up questions to show interest. "
-                        "Keep responses concise (1-3 paragraphs at most) but meaningful. "
-                        "Feel free to use emojis occasionally to express emotion. "
-                        "Remember details about the user from previous messages in the conversation."
-                    )
-                }
+            # System message to make responses more conversational
+            system_message = {
+                "role": "system", 
+                "content": (
+                    "You are a friendly and conversational AI chatbot in a Discord server. "
+                    "You're talking with a real person who might be feeling lonely. "
+                    "Be warm, empathetic, and engage naturally like a friend would. "
+                    "Ask follow-up questions to show interest. "
+                    "Keep responses concise (1-3 paragraphs at most) but meaningful. "
+                    "Feel free to use emojis occasionally to express emotion. "
+                    "Remember details about the user from previous messages in the conversation."
+                )
+            }
+            
+            # Prepare payload with conversation history
+            payload = {
+                "messages": [system_message] + context.messages() + [user_turn],
+                "model": self.chat_model,
+                "temperature": self.temperature,
+                "max_tokens": 2000,
+                "top_p": 1
+            }
+            
+            # Someone in a voice channel is waiting to hear this, it goes ahead of text-only replies
+            priority = self.request_priority(message.guild)
+            
+            if self.stream_responses:
+                on_first_token = inbox.start_replying if inbox else None
+                reply = await self.stream_chat_response(
+                    message.channel, payload, thinking_msg, on_first_token, priority, guild_id
+                )
+                if reply is not None:
+                    # Add the turn and bot response to history
+                    self.add_to_history(channel_id, context, "user", user_input)
+                    self.add_to_history(channel_id, context, "assistant", reply)
+                    pending_user_turn = False
+                    
+                    # Say the response in voice if in a voice channel
+                    if message.guild and message.guild.id in self.voice_clients:
+                        self.play_voice_message(message.guild.id, reply)
+                return
+            
+            requested = time.perf_counter()
+            try:
+                async with contextlib.aclosing(self.router.stream(
+                    payload, priority, self.estimate_payload_tokens(payload), stream=False
+                )) as deltas:
+                    reply = "".join([delta async for delta in deltas]) or "I have no response."
+                metrics.observe("llm_total", time.perf_counter() - requested)
+            except ModelUnavailable as e:
+                logger.error(f"API Error: {str(e)}")
+                reply = None
                 
-                # Prepare payload with conversation history
-                payload = {
-                    "messages": [system_message] + self.conversation_history[channel_id],
-                    "model": self.chat_model,
-                    "temperature": self.temperature,
-                    "max_tokens": 2000,
-                    "top_p": 1
-                }
+            # Delete the thinking message
+            if thinking_msg is not None:
+                self.rest_budget.spend("delete", message.channel.id)
+                await thinking_msg.delete()
+                thinking_msg = None
+            
+            if reply is not None:
+                if inbox:
+                    inbox.start_replying()
                 
-                async with session.post(self.chat_api_url, headers=headers, json=payload) as response:
-                    # Delete the thinking message
-                    await thinking_msg.delete()
-                    
-                    if response.status == 200:
-                        data = await response.json()
-                        reply = data.get('choices', [])[0].get('message', {}).get('content', 'I have no response.')
-                        
-                        # Add bot response to history
-                        self.conversation_history[channel_id].append({"role": "assistant", "content": reply})
-                        
-                        # Split long responses into chunks
-                        if len(reply) > 2000:
-                            chunks = [reply[i:i+1994] for i in range(0, len(reply), 1994)]
-                            for i, chunk in enumerate(chunks):
-                                if i == 0:
-                                    await message.channel.send(chunk)
-                                else:
-                                    await message.channel.send(f"...(continued) {chunk}")
-                        else:
-                            await message.channel.send(reply)
-                            
-                        # Say the response in voice if in a voice channel
-                        if message.guild and message.guild.id in self.voice_clients:
-                            await self.play_voice_message(message.guild.id, reply[:500])  # Limit voice to 500 chars
+                # Add the turn and bot response to history
+                self.add_to_history(channel_id, context, "user", user_input)
+                self.add_to_history(channel_id, context, "assistant", reply)
+                pending_user_turn = False
+                
+                # Split long responses into chunks
+                with metrics.timer("discord_send"):
+                    self.rest_budget.spend("send", message.channel.id)
+                    if len(reply) > 2000:
+                        chunks = [reply[i:i+1994] for i in range(0, len(reply), 1994)]
+                        for i, chunk in enumerate(chunks):
+                            if i == 0:
+                                await message.channel.send(chunk)
+                            else:
+                                await message.channel.send(f"...(continued) {chunk}")
                     else:
-                        error_data = await response.text()
-                        logger.error(f"API Error: {error_data}")
-                        await message.channel.send("❌ I'm having trouble connecting to my brain right now. Please try again later.")
+                        await message.channel.send(reply)
+                    
+                # Say the response in voice if in a voice channel
+                if message.guild and message.guild.id in self.voice_clients:
+                    self.play_voice_message(message.guild.id, reply)
+            else:
+                await message.channel.send("❌ I'm having trouble connecting to my brain right now. Please try again later.")
+        except asyncio.CancelledError:
+            # Superseded by a newer message before anything was shown, the turn is retried merged
+            pending_user_turn = False
+            turn_started = None
+            if thinking_msg is not None:
+                with contextlib.suppress(Exception):
+                    await thinking_msg.delete()
+            raise
         except Exception as e:
             logger.error(f"Error in chat_response: {str(e)}", exc_info=True)
             await message.channel.send("❌ Something went wrong processing your message. Please try again.")
             
         finally:
-            # Cancel typing indicator
-            if channel_id in self.typing_indicators and not self.typing_indicators[channel_id].done():
-                self.typing_indicators[channel_id].cancel()
+            if pending_user_turn:
+                # Failed turns are still remembered, like before
+                self.add_to_history(channel_id, context, "user", user_input)
+            self.history.release(channel_id)
+            if turn_started is not None:
+                metrics.observe("turn_total", time.perf_counter() - turn_started)
+            # Stop typing unless something else is still working in this channel
+            self.typing.release(message.channel)
                 
-    async def show_typing_indicator(self, channel):
+    def request_priority(self, guild):
+        if guild and guild.id in self.voice_clients:
+            return RequestScheduler.PRIORITY_VOICE
+        return RequestScheduler.PRIORITY_TEXT
+
+    def estimate_payload_tokens(self, payload):
+        # Prompt plus a typical reply, reserving the full max_tokens would starve the TPM bucket
+        prompt = sum(estimate_tokens(message["content"]) for message in payload["messages"])
+        return prompt + min(payload.get("max_tokens", 0), self.completion_token_reserve)
+
+    def add_to_history(self, channel_id, context, role, content):
+        context.append(role, content)
+        self.history.mark_dirty(channel_id, context)
+        if context.needs_summary():
+            # Refreshed in the background, the reply never waits on it, and holds the channel until it is done
+            self.history.pin(channel_id)
+            context.summary_task = asyncio.create_task(self.refresh_summary(channel_id, context))
+            context.summary_task.add_done_callback(lambda _: self.history.release(channel_id))
+
+    async def refresh_summary(self, channel_id, context):
+        batch = context.take_evicted()
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message, _ in batch)
+        payload = {
+            "messages": [
+                {
+                    "role": "system",
+                    "content": (
+                        "You maintain a running summary of a Discord conversation between a user and a friendly chatbot. "
+                        "Merge the new messages into the current summary. Keep names, facts about the user, "
+                        "open questions and the emotional tone. Reply with the summary only, at most 150 words."
+                    )
+                },
+                {
+                    "role": "user",
+                    "content": f"Current summary:\n{context.summary or '(none yet)'}\n\nNew messages:\n{transcript}"
+                }
+            ],
+            "model": self.summary_model,
+            "temperature": 0.3,
+            "max_tokens": 300
+        }
         try:
-            async with channel.typing():
-                # Keep typing until cancelled
-                while True:
-                    await asyncio.sleep(1)
+            async with self.http.post(
+                self.chat_api_url, json=payload, timeout=self.chat_timeout,
+                priority=RequestScheduler.PRIORITY_BACKGROUND, tokens=self.estimate_payload_tokens(payload)
+            ) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    summary = data.get('choices', [{}])[0].get('message', {}).get('content', '')
+                    if summary:
+                        context.set_summary(summary)
+                        self.history.mark_dirty(channel_id, context)
+                        return
+                else:
+                    error_data = await response.text()
+                    logger.error(f"Summary API Error: {error_data}")
         except asyncio.CancelledError:
-            pass
+            raise
         except Exception as e:
-            logger.error(f"Error in typing indicator: {str(e)}")
+            logger.error(f"Error in refresh_summary: {str(e)}", exc_info=True)
+        context.restore_evicted(batch)
+        self.history.mark_dirty(channel_id, context)
 
-    async def transcribe_audio(self, attachment):
-        file_path = f"./temp_{attachment.filename}"
+    async def stream_chat_response(self, channel, payload, thinking_msg, on_first_token=None,
+                                   priority=RequestScheduler.PRIORITY_TEXT, guild_id=None):
+        """Post a completion as it streams in, returns the full reply or None on failure"""
+        # The first tokens replace the thinking message instead of a delete + send
+        streamer = StreamingReply(
+            channel, first_message=thinking_msg, edit_interval=self.stream_edit_interval,
+            budget=self.rest_budget, guild_id=guild_id
+        )
+        requested = time.perf_counter()
+        try:
+            async with contextlib.aclosing(self.router.stream(
+                payload, priority, self.estimate_payload_tokens(payload)
+            )) as deltas:
+                async for delta in deltas:
+                    if streamer.first_token_time is None:
+                        metrics.observe("llm_first_token", time.perf_counter() - requested)
+                        if on_first_token:
+                            on_first_token()
+                    await streamer.feed(delta)
+        except ModelUnavailable as e:
+            # Nothing was shown yet, every model failed before its first token
+            if thinking_msg is not None:
+                await thinking_msg.delete()
+            logger.error(f"API Error: {str(e)}")
+            await channel.send("❌ I'm having trouble connecting to my brain right now. Please try again later.")
+            return None
+        metrics.observe("llm_total", time.perf_counter() - requested)
+        reply = await streamer.finish()
+        
+        if not reply.strip():
+            if thinking_msg is not None:
+                await thinking_msg.delete()
+            reply = "I have no response."
+            await channel.send(reply)
+        return reply
+                
+    def audio_rejection_reason(self, attachment, content_type=None, size=None):
+        """Why an attachment can't be transcribed, or None if it looks fine"""
+        size = attachment.size if size is None else size
+        if size and size > self.stt_max_bytes:
+            return f"That audio file is too large ({size / 1024 / 1024:.1f} MB, max {self.stt_max_bytes / 1024 / 1024:.0f} MB)."
+        content_type = (content_type or attachment.content_type or "").split(";")[0].strip().lower()
+        if content_type and not (content_type.startswith("audio/") or content_type in AUDIO_CONTENT_TYPES):
+            return "That file doesn't look like audio."
+        return None
+
+    async def iter_audio_chunks(self, content, max_bytes, hasher=None, chunk_size=64 * 1024):
+        # Enforce the size limit on the actual bytes too, the declared size may be missing or wrong
+        received = 0
+        async for chunk in content.iter_chunked(chunk_size):
+            received += len(chunk)
+            if received > max_bytes:
+                raise AudioRejected(f"audio exceeded {max_bytes} bytes while streaming")
+            if hasher is not None:
+                hasher.update(chunk)
+            yield chunk
+
+    async def transcribe_audio(self, attachment, priority=RequestScheduler.PRIORITY_TEXT):
+        with metrics.timer("stt_attachment"):
+            return await self.transcribe_audio_uncached(attachment, priority)
+
+    async def transcribe_audio_uncached(self, attachment, priority):
+        # Cheap pre-check: the very same attachment (forwards, re-runs) needs no download at all
+        attachment_key = f"attachment:{attachment.id}:{attachment.size}"
+        cached = await self.transcripts.get(attachment_key)
+        if cached is not None:
+            return cached
+        return await self.transcripts.single_flight(
+            attachment_key, lambda: self.transcribe_attachment(attachment, attachment_key, priority)
+        )
+
+    async def transcribe_attachment(self, attachment, attachment_key, priority):
         try:
-            await attachment.save(file_path)
+            if self.audio_preprocessor is not None:
+                try:
+                    return await self.transcribe_normalized(attachment, attachment_key, priority)
+                except AudioPreprocessingError as e:
+                    logger.warning(f"Could not preprocess {attachment.filename}, uploading it as is: {str(e)}")
+                    
+            if attachment.size and attachment.size <= self.stt_dedup_max_bytes:
+                # Small clip: hash it first so a repost of the same audio skips the upload
+                audio, content_type = await self.download_audio(attachment)
+                content_key = f"sha256:{hashlib.sha256(audio).hexdigest()}"
+                text = await self.transcripts.get(content_key)
+                if text is None:
+                    async def make_buffered_body(stack):
+                        return {"data": self.stt_form(attachment.filename, content_type, audio)}
+                    text = await self.transcripts.single_flight(
+                        content_key, lambda: self.request_transcription(make_buffered_body, priority)
+                    )
+                if text:
+                    await self.transcripts.put(text, attachment_key, content_key)
+                return text
+                
+            # Large clip: stream it from the CDN straight into the upload, hashing on the way
+            hasher = None
             
-            async with aiohttp.ClientSession() as session:
-                headers = {"Authorization": f"Bearer {self.groq_api_key}"}
-                form_data = aiohttp.FormData()
-                form_data.add_field("model", self.stt_model)
-                form_data.add_field("response_format", "verbose_json")
-                form_data.add_field("file", open(file_path, "rb"), filename=file_path)
-
-                async with session.post(self.stt_api_url, headers=headers, data=form_data) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data.get("text")
-                    else:
-                        error_data = await response.text()
-                        logger.error(f"STT API Error: {error_data}")
-                        return None
+            async def make_streamed_body(stack):
+                # Built per attempt because a streamed body can't be replayed on retry
+                nonlocal hasher
+                download = await stack.enter_async_context(self.http.get(attachment.url, timeout=self.stt_timeout))
+                download.raise_for_status()
+                content_type = download.headers.get("Content-Type", attachment.content_type)
+                rejection = self.audio_rejection_reason(attachment, content_type, download.content_length)
+                if rejection:
+                    raise AudioRejected(rejection)
+                hasher = hashlib.sha256()
+                chunks = self.iter_audio_chunks(download.content, self.stt_max_bytes, hasher)
+                return {"data": self.stt_form(attachment.filename, content_type, chunks)}
+                
+            text = await self.request_transcription(make_streamed_body, priority)
+            if text:
+                await self.transcripts.put(text, attachment_key, f"sha256:{hasher.hexdigest()}")
+            return text
         except Exception as e:
-            logger.error(f"Error in transcribe_audio: {str(e)}", exc_info=True)
+            # aiohttp wraps errors raised while it is writing the request body
+            rejected = e if isinstance(e, AudioRejected) else e.__cause__
+            if isinstance(rejected, AudioRejected):
+                logger.warning(f"Rejected attachment {attachment.filename}: {str(rejected)}")
+            else:
+                logger.error(f"Error in transcribe_audio: {str(e)}", exc_info=True)
             return None
+
+    async def transcribe_normalized(self, attachment, attachment_key, priority):
+        # The download is hashed and fed to FFmpeg as it arrives
+        hasher = hashlib.sha256()
+        async with self.http.get(attachment.url, timeout=self.stt_timeout) as download:
+            download.raise_for_status()
+            content_type = download.headers.get("Content-Type", attachment.content_type)
+            rejection = self.audio_rejection_reason(attachment, content_type, download.content_length)
+            if rejection:
+                raise AudioRejected(rejection)
+            pcm, silences = await self.audio_preprocessor.decode(
+                self.iter_audio_chunks(download.content, self.stt_max_bytes, hasher)
+            )
+            
+        content_key = f"sha256:{hasher.hexdigest()}"
+        text = await self.transcripts.get(content_key)
+        if text is None:
+            text = await self.transcripts.single_flight(
+                content_key, lambda: self.transcribe_pcm(pcm, silences, priority)
+            )
+        if text:
+            await self.transcripts.put(text, attachment_key, content_key)
+        return text
+
+    async def transcribe_pcm(self, pcm, silences, priority):
+        preprocessor = self.audio_preprocessor
+        duration = len(pcm) / preprocessor.BYTES_PER_SECOND
+        segments = preprocessor.plan_segments(duration, silences)
+        limit = asyncio.Semaphore(self.stt_segment_concurrency)
+        
+        async def transcribe_segment(start, end):
+            async with limit:
+                audio = await preprocessor.encode(preprocessor.slice_pcm(pcm, start, end))
+                
+                async def make_body(stack):
+                    return {"data": self.stt_form("audio.ogg", "audio/ogg", audio)}
+                return await self.request_transcription(make_body, priority)
+                
+        tasks = [asyncio.create_task(transcribe_segment(start, end)) for start, end in segments]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                if await finished is None:
+                    # A hole in the middle would be worse than no transcript
+                    return None
+        finally:
+            # The first failure stops the encodes and uploads still running for the other segments
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        texts = [task.result() for task in tasks]
+        return " ".join(text.strip() for text in texts if text.strip())
+
+    async def download_audio(self, attachment):
+        async with self.http.get(attachment.url, timeout=self.stt_timeout) as download:
+            download.raise_for_status()
+            content_type = download.headers.get("Content-Type", attachment.content_type)
+            rejection = self.audio_rejection_reason(attachment, content_type, download.content_length)
+            if rejection:
+                raise AudioRejected(rejection)
+            chunks = [chunk async for chunk in self.iter_audio_chunks(download.content, self.stt_max_bytes)]
+        return b"".join(chunks), content_type
+
+    def stt_form(self, filename, content_type, audio):
+        form_data = aiohttp.FormData()
+        form_data.add_field("model", self.stt_model)
+        form_data.add_field("response_format", "verbose_json")
+        form_data.add_field("file", audio, filename=filename, content_type=content_type or "application/octet-stream")
+        return form_data
+
+    async def request_transcription(self, make_body, priority):
+        with metrics.timer("stt_request"):
+            async with self.http.post(
+                self.stt_api_url, timeout=self.stt_timeout, priority=priority, body_factory=make_body
+            ) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    return data.get("text")
+                else:
+                    error_data = await response.text()
+                    logger.error(f"STT API Error: {error_data}")
+                    return None
+
+    def start_listening(self, guild, source, channel):
+        """Transcribe what people say in the guild's voice channel into chat turns in channel"""
+        self.stop_listening(guild.id)
+        receiver = VoiceReceiver(
+            threshold_db=self.voice_vad_threshold_db, hangover_ms=self.voice_vad_hangover_ms,
+            max_utterance_seconds=self.voice_max_utterance_seconds, queue_size=self.voice_queue_size
+        )
+        tasks = [
+            asyncio.create_task(source.listen(receiver.feed)),
+            asyncio.create_task(receiver.run()),
+            asyncio.create_task(self.run_voice_listener(guild, receiver, channel))
+        ]
+        self.listeners[guild.id] = (receiver, source, tasks)
+        return receiver
+
+    def stop_listening(self, guild_id):
+        listener = self.listeners.pop(guild_id, None)
+        if listener:
+            for task in listener[2]:
+                task.cancel()
+
+    async def run_voice_listener(self, guild, receiver, channel):
+        limit = asyncio.Semaphore(self.voice_stt_concurrency)
+        in_flight = set()
+        previous = None
+        try:
+            while True:
+                speaker_id, pcm, ended_at = await receiver.next_utterance()
+                member = guild.get_member(speaker_id)
+                if member is None or member.bot:
+                    continue
+                # Utterances are transcribed concurrently but answered in the order they were spoken
+                previous = asyncio.create_task(
+                    self.handle_voice_utterance(channel, member, pcm, ended_at, limit, previous)
+                )
+                in_flight.add(previous)
+                previous.add_done_callback(in_flight.discard)
         finally:
-            # Clean up the temporary file
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
-    async def play_voice_message(self, guild_id, text):
-        if guild_id in self.voice_clients:
-            vc = self.voice_clients[guild_id]
-            if vc and vc.is_connected():
+            for task in in_flight:
+                task.cancel()
+
+    async def handle_voice_utterance(self, channel, member, pcm, ended_at, limit, previous):
+        text = None
+        async with limit:
+            if time.monotonic() - ended_at > self.voice_stale_seconds:
+                # Waited too long behind other speech, answering it now would be out of place
+                self.voice_stats["stale_dropped"] += 1
+            else:
                 try:
-                    # Split text into sentences for more natural pauses
-                    sentences = self.split_into_sentences(text)
-                    file_path = f"response_{guild_id}.mp3"
-                    
-                    # Create TTS with appropriate speaking speed
-                    tts = gTTS(text=text, slow=(self.speaking_speed < 1.0))
-                    tts.save(file_path)
-                    
-                    # Play the audio
-                    if vc.is_playing():
-                        vc.stop()
-                        
-                    vc.play(FFmpegPCMAudio(file_path))
-                    
-                    # Wait for voice to finish
-                    while vc.is_playing():
-                        await asyncio.sleep(0.5)
-                        
-                    # Clean up the file
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        
+                    with self.typing.hold(channel):
+                        text = await self.transcribe_speech(pcm)
                 except Exception as e:
-                    logger.error(f"Error in play_voice_message: {str(e)}", exc_info=True)
+                    logger.error(f"Error transcribing speech from {member.display_name}: {str(e)}")
+                    self.voice_stats["failed"] += 1
+                else:
+                    metrics.observe("voice_speech_to_text", time.monotonic() - ended_at)
+                    text = (text or "").strip()
+                    self.voice_stats["transcribed" if text else "empty"] += 1
+                    
+        if previous is not None:
+            await asyncio.wait([previous])
+        if not text:
+            return
+        message = SpokenMessage(channel, member, channel.guild)
+        if self.inbound.admit(message) is not None:
+            # Nobody is looking at the channel to read a notice, just don't answer
+            self.voice_stats["shed"] += 1
+            return
+        try:
+            await channel.send(f"🎤 **{member.display_name} said:** {text}")
+        except Exception:
+            self.inbound.release(message)
+            raise
+        self.submit_turn(message, text)
+
+    async def transcribe_speech(self, pcm):
+        """Transcribe 48 kHz stereo PCM from a voice channel"""
+        audio = None
+        if self.audio_preprocessor is not None:
+            try:
+                audio = await self.audio_preprocessor.encode(
+                    pcm, sample_rate=VoiceReceiver.SAMPLE_RATE, channels=VoiceReceiver.CHANNELS
+                )
+                filename, content_type = "speech.ogg", "audio/ogg"
+            except AudioPreprocessingError as e:
+                logger.warning(f"Could not encode speech, uploading it as WAV: {str(e)}")
+        if audio is None:
+            buffer = io.BytesIO()
+            with wave.open(buffer, "wb") as wav:
+                wav.setnchannels(VoiceReceiver.CHANNELS)
+                wav.setsampwidth(2)
+                wav.setframerate(VoiceReceiver.SAMPLE_RATE)
+                wav.writeframes(pcm)
+            audio, filename, content_type = buffer.getvalue(), "speech.wav", "audio/wav"
+            
+        async def make_body(stack):
+            return {"data": self.stt_form(filename, content_type, audio)}
+        return await self.request_transcription(make_body, RequestScheduler.PRIORITY_VOICE)
+
+    def play_voice_message(self, guild_id, text, priority=GuildPlayback.PRIORITY_REPLY, barge_in=None):
+        """Queue text for speech in the guild's voice channel, returns a future that resolves once it has played"""
+        playback = self.playback.get(guild_id)
+        vc = self.voice_clients.get(guild_id)
+        if playback is None or not vc or not vc.is_connected():
+            return None
+        try:
+            # Split text into sentences so playback can start after the first one
+            sentences = self.split_into_sentences(text[:self.voice_max_chars])
+            if not sentences:
+                return None
+            
+            # Synthesis starts right away, bounded so a long reply doesn't pile up in memory
+            clips = asyncio.Queue(maxsize=self.tts_prefetch)
+            producer = asyncio.create_task(self.synthesize_sentences(guild_id, sentences, clips))
+            if barge_in is None:
+                barge_in = self.voice_barge_in and priority == GuildPlayback.PRIORITY_REPLY
+            return playback.enqueue(Utterance(clips, producer, priority), barge_in=barge_in)
+        except Exception as e:
+            logger.error(f"Error in play_voice_message: {str(e)}", exc_info=True)
+            return None
+
+    async def synthesize_sentences(self, guild_id, sentences, clips):
+        for i, sentence in enumerate(sentences):
+            try:
+                audio = await self.get_speech(sentence, guild_id)
+            except Exception as e:
+                logger.error(f"Error synthesizing sentence {i}: {str(e)}")
+                continue
+            await clips.put(audio)
+            
+        # Sentinel so the player knows the reply is done
+        await clips.put(None)
+
+    async def get_speech(self, text, guild_id=None):
+        """Encoded speech for text, from the TTS cache when possible"""
+        slow = self.speaking_speed < 1.0
+        key = self.tts_cache.key(text, self.tts_language, slow)
+        audio = self.tts_cache.get_memory(key)
+        if audio is None:
+            audio = await self.run_io(self.tts_cache.get_disk, key)
+        if audio is None:
+            # gTTS is blocking network + file I/O, keep it off the event loop
+            if guild_id is None:
+                with metrics.timer("tts_synthesis"):
+                    audio = await self.run_io(self.synthesize_audio, text, slow)
+            else:
+                async with self.tts_guild_limit(guild_id):
+                    with metrics.timer("tts_synthesis"):
+                        audio = await self.run_io(self.synthesize_audio, text, slow)
+            await self.run_io(self.tts_cache.put, key, audio)
+        return audio
+
+    def synthesize_audio(self, text, slow):
+        # Create TTS with appropriate speaking speed
+        tts = gTTS(text=text, lang=self.tts_language, slow=slow)
+        buffer = io.BytesIO()
+        tts.write_to_fp(buffer)
+        return buffer.getvalue()
+
+    async def prewarm_tts_cache(self):
+        phrases = (
+            self.personality["greeting_phrases"]
+            + self.personality["farewell_phrases"]
+            + self.personality["thinking_phrases"]
+            + self.idle_messages
+        )
+        # Cache entries are per sentence, the same way play_voice_message synthesizes them
+        sentences = list(dict.fromkeys(s for phrase in phrases for s in self.split_into_sentences(phrase)))
+        warmed = 0
+        for sentence in sentences:
+            try:
+                await self.get_speech(sentence)
+                warmed += 1
+            except Exception as e:
+                logger.warning(f"Could not pre-warm TTS for '{sentence}': {str(e)}")
+        logger.info(f"TTS cache pre-warmed with {warmed}/{len(sentences)} phrases")
 
     def split_into_sentences(self, text):
-        # Simple sentence splitting
-        return [s.strip() for s in text.replace('!', '.').replace('?', '.').split('.') if s.strip()]
+        # Split after sentence punctuation, keeping it so gTTS gets natural intonation
+        return [s.strip() for s in re.split(r'(?<=[.!?])\s+|\n+', text) if s.strip()]
         
     async def check_idle_channels(self):
-        """Background task to check for idle channels and engage users"""
+        """Background task that sleeps until the next idle deadline and engages users"""
         await self.bot.wait_until_ready()
         while not self.bot.is_closed():
             try:
-                current_time = time.time()
-                for channel_id, last_time in list(self.last_activity.items()):
-                    # If channel has been idle for between 10-15 minutes (randomly check) but less than 30 minutes
-                    idle_time = current_time - last_time
-                    if 600 < idle_time < 1800 and random.random() < 0.1:  # 10% chance every check
-                        channel = self.bot.get_channel(int(channel_id))
-                        if channel:
-                            idle_message = random.choice(self.idle_messages)
-                            await channel.send(idle_message)
-                            # Update last activity
-                            self.last_activity[channel_id] = current_time
+                self.idle_scheduler.wakeup.clear()
+                delay = self.idle_scheduler.time_until_next()
+                if delay is None or delay > 0:
+                    # Sleep until the earliest deadline, or until a channel gets armed
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self.idle_scheduler.wakeup.wait(), timeout=delay)
+                    continue
+                    
+                due = self.idle_scheduler.pop_due()
+                if due:
+                    await asyncio.gather(*(self.send_idle_nudge(channel_id, last) for channel_id, last in due))
             except Exception as e:
                 logger.error(f"Error in check_idle_channels: {str(e)}", exc_info=True)
-                
-            # Check every 5 minutes
-            await asyncio.sleep(300)
+                await asyncio.sleep(1)
+
+    async def send_idle_nudge(self, channel_id, last_activity):
+        channel = self.bot.get_channel(int(channel_id))
+        if not channel:
+            return
+        try:
+            if not await self.claim_idle_nudge(channel_id, last_activity):
+                return
+        except StateBackendError as e:
+            # Better to skip a nudge than to risk every worker sending it
+            logger.error(f"Could not claim idle nudge for {channel_id}: {str(e)}")
+            return
+        # Rolled by the lease holder only, so the odds don't grow with the number of workers
+        if random.random() < self.idle_nudge_chance:
+            async with self.idle_nudge_limit:
+                try:
+                    idle_message = random.choice(self.idle_messages)
+                    await channel.send(idle_message)
+                except Exception as e:
+                    logger.error(f"Error sending idle nudge to {channel_id}: {str(e)}")
+
+    async def claim_idle_nudge(self, channel_id, last_activity):
+        """Whether this worker is the one that nudges the channel for this idle period"""
+        if self.state.shared:
+            seen = await self.state.get(f"idle:{channel_id}")
+            if seen is not None and float(seen) > last_activity:
+                # Another worker saw the channel more recently, wait for that deadline instead
+                self.idle_scheduler.touch(channel_id, now=float(seen))
+                return False
+        # Whoever claims the nudge holds it for a full idle period, a later nudge needs new activity anyway
+        return await self.state.lease(f"idle-nudge:{channel_id}", self.instance_id, ttl=self.idle_scheduler.idle_after)
+
+    async def sync_state(self):
+        """Background task that publishes idle activity and picks up settings changed by other workers"""
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            try:
+                await self.publish_activity()
+                await self.load_settings()
+            except StateBackendError as e:
+                logger.error(f"Error syncing shared state: {str(e)}")
+            except Exception as e:
+                logger.error(f"Error in sync_state: {str(e)}", exc_info=True)
+            await asyncio.sleep(self.state_sync_interval)
+
+    async def publish_activity(self):
+        if not self.pending_activity:
+            return
+        batch, self.pending_activity = self.pending_activity, {}
+        try:
+            # Kept as long as an idle channel is still worth nudging
+            await self.state.set_many(
+                ((f"idle:{channel_id}", repr(last)) for channel_id, last in batch.items()),
+                ttl=self.idle_scheduler.expire_after
+            )
+        except StateBackendError:
+            for channel_id, last in batch.items():
+                self.pending_activity.setdefault(channel_id, last)
+            raise
+
+    async def load_settings(self):
+        if self.settings_saved_version < self.settings_version:
+            # Loading first would quietly undo our own change
+            await self.write_settings()
+            return
+        version = self.settings_version
+        record = await self.state.get("settings")
+        if not record or self.settings_version != version:
+            # Changed here while we were reading, the read is already stale
+            return
+        settings = json.loads(record)
+        self.chat_model = settings.get("chat_model", self.chat_model)
+        self.temperature = settings.get("temperature", self.temperature)
+        self.speaking_speed = settings.get("speaking_speed", self.speaking_speed)
+
+    async def save_settings(self):
+        """Share the current settings, returns False if they are only kept here until the next sync retries them"""
+        self.settings_version += 1
+        try:
+            await self.write_settings()
+            return True
+        except StateBackendError as e:
+            logger.error(f"Error saving settings: {str(e)}")
+            return False
+
+    async def write_settings(self):
+        version = self.settings_version
+        settings = {"chat_model": self.chat_model, "temperature": self.temperature, "speaking_speed": self.speaking_speed}
+        await self.state.set("settings", json.dumps(settings))
+        self.settings_saved_version = max(self.settings_saved_version, version)
+
+    def unsaved_note(self, saved):
+        return "" if saved else "\n⚠️ Couldn't share this with the other workers yet, I'll keep retrying."
 
     @commands.command(name="help")
     async def help_command(self, ctx):